@@ -18,6 +18,7 @@ import logging
 import os
 
 from mobly import test_runner
+import numpy as np
 
 import its_base_test
 import camera_properties_utils
@@ -28,6 +29,11 @@ import video_processing_utils
 
 _BIT_HLG10 = 0x01  # bit 1 for feature mask
 _BIT_STABILIZATION = 0x02  # bit 2 for feature mask
+_NUM_FEATURE_MASKS = (_BIT_HLG10 | _BIT_STABILIZATION) + 1
+# For each feature mask, the set of masks covering it, as a bit per mask
+_FEATURE_MASK_SUPERSETS = tuple(
+    sum(1 << t for t in range(_NUM_FEATURE_MASKS) if t | m == t)
+    for m in range(_NUM_FEATURE_MASKS))
 _FPS_30_60 = (30, 60)
 _FPS_SELECTION_ATOL = 0.01
 _FPS_ATOL_CODEC = 1.2
@@ -36,6 +42,38 @@ _FPS_ATOL_METADATA = 0.8
 _NAME = os.path.splitext(os.path.basename(__file__))[0]
 _SEC_TO_NSEC = 1_000_000_000
 
+_FAILURE_CODEC_FPS = 'codec_fps'
+_FAILURE_COLOR_SPACE = 'color_space'
+_FAILURE_METADATA_FPS = 'metadata_fps'
+_FAILURE_STABILIZATION = 'stabilization'
+
+
+def _format_failure(combination_name, failure_type, value, fps_range):
+  """Formats a recorded test failure into a readable message.
+
+  Args:
+    combination_name: str; name of the failing feature combination.
+    failure_type: str; one of the _FAILURE_* check names.
+    value: the measured value or failure reason for the check.
+    fps_range: list; [min, max] target fps range of the combination.
+
+  Returns:
+    str; failure message.
+  """
+  if failure_type == _FAILURE_CODEC_FPS:
+    details = (f'Average video clip frame rate {value} exceeding the allowed '
+               f'range of ({fps_range[0]}-{_FPS_ATOL_CODEC}, '
+               f'{fps_range[1]}+{_FPS_ATOL_CODEC})')
+  elif failure_type == _FAILURE_METADATA_FPS:
+    details = (f'Average frame rate {value} exceeding the allowed range of '
+               f'({fps_range[0]}-{_FPS_ATOL_METADATA}, '
+               f'{fps_range[1]}+{_FPS_ATOL_METADATA})')
+  elif failure_type == _FAILURE_COLOR_SPACE:
+    details = f'video color space {value} is missing COLORSPACE_HDR'
+  else:
+    details = value
+  return f'{combination_name}: {details}'
+
 
 class FeatureCombinationTest(its_base_test.ItsBaseTest):
   """Tests camera feature combinations.
@@ -122,9 +160,15 @@ class FeatureCombinationTest(its_base_test.ItsBaseTest):
 
       configs = props['android.scaler.streamConfigurationMap'][
           'availableStreamConfigurations']
+      # Index configs by (format, width, height), keeping the first entry
+      configs_by_fmt_size = {}
+      for config in configs:
+        configs_by_fmt_size.setdefault(
+            (config['format'], config['width'], config['height']), config)
       fps_ranges = camera_properties_utils.get_ae_target_fps_ranges(props)
 
       test_failures = []
+      codec_verification_futures = []
       preview_verification_futures = []
       combination_names = []
       for stream_combination in combinations:
@@ -146,21 +190,18 @@ class FeatureCombinationTest(its_base_test.ItsBaseTest):
             fmt = capture_request_utils.FMT_CODE_JPEG
           elif stream['format'] == its_session_utils.JPEG_R_FMT_STR:
             fmt = capture_request_utils.FMT_CODE_JPEG_R
-          config = [x for x in configs if
-                    x['format'] == fmt and
-                    x['width'] == size[0] and
-                    x['height'] == size[1]]
-          if not config:
+          config = configs_by_fmt_size.get((fmt, size[0], size[1]))
+          if config is None:
             logging.debug(
                 'stream combination %s not supported. Skip', streams_name)
             skip = True
             break
 
           min_frame_duration = max(
-              config[0]['minFrameDuration'], min_frame_duration)
+              config['minFrameDuration'], min_frame_duration)
           logging.debug(
               'format is %s, min_frame_duration is %d}',
-              stream['format'], config[0]['minFrameDuration'])
+              stream['format'], config['minFrameDuration'])
           configured_streams.append(
               {'format': stream['format'], 'width': size[0], 'height': size[1]})
 
@@ -181,8 +222,9 @@ class FeatureCombinationTest(its_base_test.ItsBaseTest):
             hlg10_params.append(True)
           hlg10_params.append(False)
 
-          features_tested = []  # feature combinations already tested
+          features_tested = 0  # bit per feature mask already tested
           for hlg10 in hlg10_params:
+            hlg10_mask = _BIT_HLG10 if hlg10 else 0
             # Construct output surfaces
             output_surfaces = []
             for configured_stream in configured_streams:
@@ -211,15 +253,16 @@ class FeatureCombinationTest(its_base_test.ItsBaseTest):
                 break
 
               is_stabilized = False
+              feature_mask = hlg10_mask
               if (stabilize ==
                   camera_properties_utils.STABILIZATION_MODE_PREVIEW):
                 is_stabilized = True
+                feature_mask |= _BIT_STABILIZATION
 
               # If a superset of features are already tested, skip.
-              skip_test = its_session_utils.check_and_update_features_tested(
-                  features_tested, hlg10, is_stabilized)
-              if skip_test:
+              if features_tested & _FEATURE_MASK_SUPERSETS[feature_mask]:
                 continue
+              features_tested |= 1 << feature_mask
 
               # TODO: b/341299485 - parallelize preview recording
               recording_obj = (
@@ -227,50 +270,52 @@ class FeatureCombinationTest(its_base_test.ItsBaseTest):
                       cam, self.tablet_device, output_surfaces, is_stabilized,
                       rot_rig=rot_rig, fps_range=fps_range))
 
+              # Grab the video from the file location on DUT in the
+              # background while the gyro events are read out
+              pull_future = executor.submit(
+                  self.dut.adb.pull,
+                  [recording_obj['recordedOutputPath'], log_path])
+
               if is_stabilized:
                 # Get gyro events
                 logging.debug('Reading out inertial sensor events')
                 gyro_events = cam.get_sensor_events()['gyro']
                 logging.debug('Number of gyro samples %d', len(gyro_events))
 
-              # Grab the video from the file location on DUT
-              self.dut.adb.pull([recording_obj['recordedOutputPath'], log_path])
+              pull_future.result()
 
-              # Verify FPS by inspecting the video clip
-              preview_file_name = (
-                  recording_obj['recordedOutputPath'].split('/')[-1])
+              # Schedule FPS and color space checks of the video clip to run
+              # asynchronously
+              preview_file_name = os.path.basename(
+                  recording_obj['recordedOutputPath'])
               preview_file_name_with_path = os.path.join(
                   self.log_path, preview_file_name)
-              average_frame_rate_codec = (
-                  video_processing_utils.get_average_frame_rate(
-                      preview_file_name_with_path))
-              logging.debug('Average codec frame rate for %s is %f', combination_name,
-                            average_frame_rate_codec)
-              if (average_frame_rate_codec > fps_range[1] + _FPS_ATOL_CODEC or
-                  average_frame_rate_codec < fps_range[0] - _FPS_ATOL_CODEC):
-                failure_msg = (
-                    f'{combination_name}: Average video clip frame rate '
-                    f'{average_frame_rate_codec} exceeding the allowed range of '
-                    f'({fps_range[0]}-{_FPS_ATOL_CODEC}, '
-                    f'{fps_range[1]}+{_FPS_ATOL_CODEC})')
-                test_failures.append(failure_msg)
+              fps_future = executor.submit(
+                  video_processing_utils.get_average_frame_rate,
+                  preview_file_name_with_path)
+              color_space_future = executor.submit(
+                  video_processing_utils.get_video_colorspace,
+                  self.log_path, preview_file_name_with_path)
+              codec_verification_futures.append(
+                  (combination_name, fps_range, hlg10, fps_future,
+                   color_space_future))
 
               # Verify FPS by inspecting the result metadata
-              capture_results = recording_obj['captureMetadata'];
+              capture_results = recording_obj['captureMetadata']
               assert len(capture_results) > 1
-              last_t = capture_results[-1]['android.sensor.timestamp'];
-              first_t = capture_results[0]['android.sensor.timestamp'];
-              average_frame_duration = (last_t - first_t) / (len(capture_results) - 1)
-              average_frame_rate_metadata = _SEC_TO_NSEC / average_frame_duration
-              logging.debug('Average metadata frame rate for %s is %f', combination_name,
-                            average_frame_rate_metadata)
+              frame_durations = np.diff(np.fromiter(
+                  (c['android.sensor.timestamp'] for c in capture_results),
+                  dtype=np.int64, count=len(capture_results)))
+              average_frame_rate_metadata = (
+                  _SEC_TO_NSEC / frame_durations.mean())
+              logging.debug('Average metadata frame rate for %s is %f, '
+                            'frame duration std dev: %.1f ns', combination_name,
+                            average_frame_rate_metadata, frame_durations.std())
               if (average_frame_rate_metadata > fps_range[1] + _FPS_ATOL_METADATA or
                   average_frame_rate_metadata < fps_range[0] - _FPS_ATOL_METADATA):
-                failure_msg = (
-                    f'{combination_name}: Average frame rate '
-                    f'{average_frame_rate_metadata} exceeding the allowed range of '
-                    f'({fps_range[0]}-{_FPS_ATOL_METADATA}, {fps_range[1]}+{_FPS_ATOL_METADATA})')
-                test_failures.append(failure_msg)
+                test_failures.append(
+                    (combination_name, _FAILURE_METADATA_FPS,
+                     average_frame_rate_metadata, fps_range))
 
               # Schedule stabilization verification to run asynchronously
               if is_stabilized:
@@ -280,15 +325,22 @@ class FeatureCombinationTest(its_base_test.ItsBaseTest):
                 preview_verification_futures.append(future)
                 combination_names.append(combination_name)
 
-              # Verify color space
-              color_space = video_processing_utils.get_video_colorspace(
-                  self.log_path, preview_file_name_with_path)
-              if (hlg10 and
-                  video_processing_utils.COLORSPACE_HDR not in color_space):
-                failure_msg = (
-                    f'{combination_name}: video color space {color_space} '
-                    'is missing COLORSPACE_HDR')
-                test_failures.append(failure_msg)
+      # Verify FPS and color space of the video clips
+      for (name, fps_range, hlg10, fps_future,
+           color_space_future) in codec_verification_futures:
+        average_frame_rate_codec = fps_future.result()
+        logging.debug('Average codec frame rate for %s is %f', name,
+                      average_frame_rate_codec)
+        if (average_frame_rate_codec > fps_range[1] + _FPS_ATOL_CODEC or
+            average_frame_rate_codec < fps_range[0] - _FPS_ATOL_CODEC):
+          test_failures.append(
+              (name, _FAILURE_CODEC_FPS, average_frame_rate_codec, fps_range))
+
+        color_space = color_space_future.result()
+        if (hlg10 and
+            video_processing_utils.COLORSPACE_HDR not in color_space):
+          test_failures.append(
+              (name, _FAILURE_COLOR_SPACE, color_space, fps_range))
 
       # Verify preview stabilization
       for future, name in zip(preview_verification_futures, combination_names):
@@ -296,12 +348,14 @@ class FeatureCombinationTest(its_base_test.ItsBaseTest):
         logging.debug('Stabilization result for %s: %s',
                       name, stabilization_result)
         if stabilization_result['failure']:
-          failure_msg = f'{name}: {stabilization_result["failure"]}'
-          test_failures.append(failure_msg)
+          test_failures.append(
+              (name, _FAILURE_STABILIZATION, stabilization_result['failure'],
+               None))
 
       # Assert PASS/FAIL criteria
       if test_failures:
-        raise AssertionError(test_failures)
+        raise AssertionError('\n'.join(
+            [_format_failure(*failure) for failure in test_failures]))
 
 if __name__ == '__main__':
   test_runner.main()
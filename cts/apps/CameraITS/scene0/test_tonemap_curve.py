@@ -13,6 +13,7 @@
 # limitations under the License.
 """CameraITS test for tonemap curve with sensor test pattern."""
 
+import concurrent.futures
 import logging
 import os
 
@@ -34,7 +35,13 @@ _N_BARS = len(_COLOR_BARS)
 _COLOR_CHECKER = {'BLACK': [0, 0, 0], 'RED': [1, 0, 0], 'GREEN': [0, 1, 0],
                   'BLUE': [0, 0, 1], 'MAGENTA': [1, 0, 1], 'CYAN': [0, 1, 1],
                   'YELLOW': [1, 1, 0], 'WHITE': [1, 1, 1]}
+# Color bar values are 0 or 1 per channel, so each maps to a 3-bit RGB code
+_COLOR_CODE_WEIGHTS = np.array([4, 2, 1])
+_COLOR_CODE_THRESH = 0.5
+_CODE_TO_COLOR = {
+    int(np.dot(_COLOR_CHECKER[c], _COLOR_CODE_WEIGHTS)): c for c in _COLOR_BARS}
 _DELTA = 0.005  # crop on each edge of color bars
+_ERROR_IMG_WRITE_WORKERS = 2
 _RAW_ATOL = 0.001  # 1 DN in [0:1] (1/(1023-64)
 _RGB_VAR_ATOL = 0.0039  # 1/255
 _RGB_MEAN_ATOL = 0.1
@@ -46,8 +53,14 @@ _Y_NORM = 0.0
 _W_NORM = 1.0 / _N_BARS - 2 * _DELTA
 _H_NORM = 1.0
 
-# Linear tonemap with maximum of 0.5
-_LINEAR_TONEMAP = sum([[i/63.0, i/126.0] for i in range(64)], [])
+# Linear tonemap with maximum of 0.5, as interleaved [in, out] points
+_LINEAR_TONEMAP = np.column_stack(
+    (np.arange(64) / 63.0, np.arange(64) / 126.0)).ravel().tolist()
+_LINEAR_TONEMAP_CURVE = {
+    'red': _LINEAR_TONEMAP,
+    'green': _LINEAR_TONEMAP,
+    'blue': _LINEAR_TONEMAP
+}
 
 
 def get_yuv_patch_coordinates(num, w_orig, w_crop):
@@ -102,25 +115,32 @@ def check_raw_pattern(img_raw):
     img_raw: RAW image
   """
   logging.debug('Checking RAW/PATTERN match')
-  color_match = []
+  raw_means = []
   for n in range(_N_BARS):
     x_norm = get_x_norm(n)
-    raw_patch = image_processing_utils.get_image_patch(img_raw, x_norm, _Y_NORM,
-                                                       _W_NORM, _H_NORM)
-    raw_means = image_processing_utils.compute_image_means(raw_patch)
+    raw_patch = image_processing_utils.get_image_patch(
+        img_raw, x_norm, _Y_NORM, _W_NORM, _H_NORM, dtype=np.float32)
+    raw_means.append(image_processing_utils.compute_image_means(raw_patch))
     logging.debug('patch: %d, x_norm: %.3f, RAW means: %s',
-                  n, x_norm, str(raw_means))
-    for color in _COLOR_BARS:
-      if np.allclose(_COLOR_CHECKER[color], raw_means, atol=_RAW_ATOL):
-        color_match.append(color)
-        logging.debug('%s match', color)
-        break
-      else:
-        logging.debug('No match w/ %s: %s, ATOL: %.3f',
-                      color, str(_COLOR_CHECKER[color]), _RAW_ATOL)
-  if set(color_match) != set(_COLOR_BARS):
+                  n, x_norm, str(raw_means[n]))
+
+  # Nearest color is found by thresholding each channel to a 3-bit code
+  raw_means = np.array(raw_means)
+  codes = (raw_means > _COLOR_CODE_THRESH).dot(_COLOR_CODE_WEIGHTS)
+  remaining_colors = set(_COLOR_BARS)
+  for n, code in enumerate(codes):
+    color = _CODE_TO_COLOR[code]
+    diff = np.abs(raw_means[n] - _COLOR_CHECKER[color]).max()
+    if diff > _RAW_ATOL:
+      raise AssertionError(
+          f'RAW _COLOR_BARS patch {n} does not match any color. Closest: '
+          f'{color}, diff: {diff:.4f}, ATOL: {_RAW_ATOL}')
+    logging.debug('patch: %d, %s match', n, color)
+    remaining_colors.discard(color)
+  if remaining_colors:
     raise AssertionError(
-        'RAW _COLOR_BARS test pattern does not have all colors')
+        'RAW _COLOR_BARS test pattern does not have all colors. Missing: '
+        f'{sorted(remaining_colors)}')
 
 
 def check_yuv_vs_raw(img_raw, img_yuv, name_with_log_path):
@@ -151,45 +171,58 @@ def check_yuv_vs_raw(img_raw, img_yuv, name_with_log_path):
         img_raw, x_norm_raw, 0, w_norm_raw, 1)
     raw_w_cropped = img_raw.shape[1]
     logging.debug('New RAW W, H: %d, %d', raw_w_cropped, img_raw.shape[0])
-    image_processing_utils.write_image(
-        img_raw, f'{name_with_log_path}_raw_cropped_COLOR_BARS.jpg', True)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      image_processing_utils.write_image(
+          img_raw, f'{name_with_log_path}_raw_cropped_COLOR_BARS.jpg', True)
+
+  # Extract YUV and RAW color patches
+  raw_patches = []
+  yuv_patches = []
+  for n in range(_N_BARS):
+    x_norm, w_norm = get_yuv_patch_coordinates(n, raw_w, raw_w_cropped)
+    raw_patches.append(image_processing_utils.get_image_patch(
+        img_raw, x_norm, _Y_NORM, w_norm, _H_NORM, dtype=np.float32))
+    yuv_patches.append(image_processing_utils.get_image_patch(
+        img_yuv, x_norm, _Y_NORM, w_norm, _H_NORM, dtype=np.float32))
+
+  # Per-patch channel stats as (bar, ch) arrays
+  raw_means, raw_vars = map(np.array, zip(*[
+      image_processing_utils.compute_image_means_and_variances(p)
+      for p in raw_patches]))
+  yuv_means, yuv_vars = map(np.array, zip(*[
+      image_processing_utils.compute_image_means_and_variances(p)
+      for p in yuv_patches]))
+  yuv_means /= _TONEMAP_MAX  # Normalize to tonemap max
 
   # Compare YUV and RAW color patches
+  means_match = np.isclose(raw_means, yuv_means, atol=_RGB_MEAN_ATOL).all(
+      axis=1)
+  vars_match = np.isclose(raw_vars, yuv_vars, atol=_RGB_VAR_ATOL).all(axis=1)
   color_match_errs = []
   color_variance_errs = []
-  for n in range(_N_BARS):
-    x_norm, w_norm = get_yuv_patch_coordinates(n, raw_w, raw_w_cropped)
-    raw_patch = image_processing_utils.get_image_patch(img_raw, x_norm, _Y_NORM,
-                                                       w_norm, _H_NORM)
-    yuv_patch = image_processing_utils.get_image_patch(img_yuv, x_norm, _Y_NORM,
-                                                       w_norm, _H_NORM)
-    raw_means = np.array(image_processing_utils.compute_image_means(raw_patch))
-    raw_vars = np.array(
-        image_processing_utils.compute_image_variances(raw_patch))
-    yuv_means = np.array(image_processing_utils.compute_image_means(yuv_patch))
-    yuv_means /= _TONEMAP_MAX  # Normalize to tonemap max
-    yuv_vars = np.array(
-        image_processing_utils.compute_image_variances(yuv_patch))
-    if not np.allclose(raw_means, yuv_means, atol=_RGB_MEAN_ATOL):
+  # Error patches are saved in the background; exiting the block waits for them
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=_ERROR_IMG_WRITE_WORKERS) as executor:
+    for n in np.flatnonzero(~means_match):
       color_match_errs.append(
-          f'means RAW: {raw_means}, RGB(norm): {np.round(yuv_means, 3)}, '
+          f'means RAW: {raw_means[n]}, RGB(norm): {np.round(yuv_means[n], 3)}, '
           f'ATOL: {_RGB_MEAN_ATOL}')
-      image_processing_utils.write_image(
-          raw_patch, f'{name_with_log_path}_match_error_raw_{n}.jpg',
-          apply_gamma=True)
-      image_processing_utils.write_image(
-          yuv_patch, f'{name_with_log_path}_match_error_yuv_{n}.jpg',
-          apply_gamma=True)
-    if not np.allclose(raw_vars, yuv_vars, atol=_RGB_VAR_ATOL):
+      executor.submit(
+          image_processing_utils.write_image, raw_patches[n],
+          f'{name_with_log_path}_match_error_raw_{n}.jpg', apply_gamma=True)
+      executor.submit(
+          image_processing_utils.write_image, yuv_patches[n],
+          f'{name_with_log_path}_match_error_yuv_{n}.jpg', apply_gamma=True)
+    for n in np.flatnonzero(~vars_match):
       color_variance_errs.append(
-          f'variances RAW: {raw_vars}, RGB: {yuv_vars}, '
+          f'variances RAW: {raw_vars[n]}, RGB: {yuv_vars[n]}, '
           f'ATOL: {_RGB_VAR_ATOL}')
-      image_processing_utils.write_image(
-          raw_patch, f'{name_with_log_path}_variance_error_raw_{n}.jpg',
-          apply_gamma=True)
-      image_processing_utils.write_image(
-          yuv_patch, f'{name_with_log_path}_variance_error_yuv_{n}.jpg',
-          apply_gamma=True)
+      executor.submit(
+          image_processing_utils.write_image, raw_patches[n],
+          f'{name_with_log_path}_variance_error_raw_{n}.jpg', apply_gamma=True)
+      executor.submit(
+          image_processing_utils.write_image, yuv_patches[n],
+          f'{name_with_log_path}_variance_error_yuv_{n}.jpg', apply_gamma=True)
 
   # Print all errors before assertion
   if color_match_errs:
@@ -228,8 +261,9 @@ def test_tonemap_curve_impl(name_with_log_path, cam, props):
       cap_raw, props=props)
 
   # Save RAW pattern
-  image_processing_utils.write_image(
-      img_raw, f'{name_with_log_path}_raw_COLOR_BARS.jpg', True)
+  if logging.getLogger().isEnabledFor(logging.DEBUG):
+    image_processing_utils.write_image(
+        img_raw, f'{name_with_log_path}_raw_COLOR_BARS.jpg', True)
 
   # Check pattern for correctness
   check_raw_pattern(img_raw)
@@ -240,18 +274,15 @@ def test_tonemap_curve_impl(name_with_log_path, cam, props):
   req_yuv['android.sensor.testPatternMode'] = _COLOR_BAR_PATTERN
   req_yuv['android.distortionCorrection.mode'] = 0
   req_yuv['android.tonemap.mode'] = 0
-  req_yuv['android.tonemap.curve'] = {
-      'red': _LINEAR_TONEMAP,
-      'green': _LINEAR_TONEMAP,
-      'blue': _LINEAR_TONEMAP
-  }
+  req_yuv['android.tonemap.curve'] = _LINEAR_TONEMAP_CURVE
   fmt_yuv = {'format': 'yuv', 'width': _YUV_W, 'height': _YUV_H}
   cap_yuv = cam.do_capture(req_yuv, fmt_yuv)
   img_yuv = image_processing_utils.convert_capture_to_rgb_image(cap_yuv, True)
 
   # Save YUV pattern
-  image_processing_utils.write_image(
-      img_yuv, f'{name_with_log_path}_yuv_COLOR_BARS.jpg', True)
+  if logging.getLogger().isEnabledFor(logging.DEBUG):
+    image_processing_utils.write_image(
+        img_yuv, f'{name_with_log_path}_yuv_COLOR_BARS.jpg', True)
 
   # Check pattern for correctness
   check_yuv_vs_raw(img_raw, img_yuv, name_with_log_path)
@@ -14,11 +14,13 @@
 """Verifies settings latch on the correct frame."""
 
 
+import concurrent.futures
 import logging
 import os.path
 import matplotlib
 from matplotlib import pylab
 from mobly import test_runner
+import numpy as np
 
 import its_base_test
 import camera_properties_utils
@@ -38,6 +40,45 @@ _REQ_PATTERN = ['base', 'base', 'iso', 'iso', 'base', 'base', 'exp',
 _PATTERN_CHECK = [r != 'base' for r in _REQ_PATTERN]
 
 
+def _compute_patch_means(cap, img_name):
+  """Converts a capture to RGB and returns the center patch means.
+
+  Args:
+    cap: capture object.
+    img_name: str; file name used to save the image when debugging.
+
+  Returns:
+    list of [r, g, b] means of the center patch.
+  """
+  img = image_processing_utils.convert_capture_to_rgb_image(cap)
+  if logging.getLogger().isEnabledFor(logging.DEBUG):
+    image_processing_utils.write_image(img, img_name)
+  patch = image_processing_utils.get_image_patch(
+      img, _PATCH_X, _PATCH_Y, _PATCH_W, _PATCH_H)
+  return image_processing_utils.compute_image_means(patch)
+
+
+def _plot_means(r_means, g_means, b_means, name_with_log_path):
+  """Plots the RGB means of each capture.
+
+  Args:
+    r_means: list of R channel means.
+    g_means: list of G channel means.
+    b_means: list of B channel means.
+    name_with_log_path: str; path and test name for the saved plot.
+  """
+  idxs = range(len(r_means))
+  pylab.figure(_NAME)
+  pylab.plot(idxs, r_means, '-ro')
+  pylab.plot(idxs, g_means, '-go')
+  pylab.plot(idxs, b_means, '-bo')
+  pylab.ylim([0, 1])
+  pylab.title(_NAME)
+  pylab.xlabel('capture')
+  pylab.ylabel('RGB means')
+  matplotlib.pyplot.savefig(f'{name_with_log_path}_plot_means.png')
+
+
 class LatchingTest(its_base_test.ItsBaseTest):
   """Test that settings latch on the right frame.
 
@@ -74,9 +115,6 @@ class LatchingTest(its_base_test.ItsBaseTest):
           log_path, cam)['midExposureTime']
 
       e /= _EXP_GAIN_FACTOR
-      r_means = []
-      g_means = []
-      b_means = []
       reqs = []
       base_req = capture_request_utils.manual_capture_request(
           s, e, 0.0, True, props)
@@ -95,35 +133,29 @@ class LatchingTest(its_base_test.ItsBaseTest):
           raise AssertionError(f'Incorrect capture request! {req_type}')
 
       caps = cam.do_capture(reqs, fmt)
-      for i, cap in enumerate(caps):
-        img = image_processing_utils.convert_capture_to_rgb_image(cap)
-        image_processing_utils.write_image(
-            img, f'{name_with_log_path}_i={i:02d}.jpg')
-        patch = image_processing_utils.get_image_patch(
-            img, _PATCH_X, _PATCH_Y, _PATCH_W, _PATCH_H)
-        rgb_means = image_processing_utils.compute_image_means(patch)
-        r_means.append(rgb_means[0])
-        g_means.append(rgb_means[1])
-        b_means.append(rgb_means[2])
+      img_names = [f'{name_with_log_path}_i={i:02d}.jpg'
+                   for i in range(len(caps))]
+      # Frames are independent; convert them concurrently, keeping order
+      rgb_means = np.empty((len(caps), 3))
+      with concurrent.futures.ThreadPoolExecutor() as executor:
+        for i, patch_means in enumerate(
+            executor.map(_compute_patch_means, caps, img_names)):
+          rgb_means[i] = patch_means
+      r_means, g_means, b_means = rgb_means.T
       logging.debug('G means: %s', str(g_means))
 
+      # check G mean pattern for correctness
+      g_high = g_means > g_means.mean()
+      g_high_matches_pattern = np.array_equal(g_high, _PATTERN_CHECK)
+
       # Plot results
-      idxs = range(len(r_means))
-      pylab.figure(_NAME)
-      pylab.plot(idxs, r_means, '-ro')
-      pylab.plot(idxs, g_means, '-go')
-      pylab.plot(idxs, b_means, '-bo')
-      pylab.ylim([0, 1])
-      pylab.title(_NAME)
-      pylab.xlabel('capture')
-      pylab.ylabel('RGB means')
-      matplotlib.pyplot.savefig(f'{name_with_log_path}_plot_means.png')
+      if (not g_high_matches_pattern or
+          logging.getLogger().isEnabledFor(logging.DEBUG)):
+        _plot_means(r_means, g_means, b_means, name_with_log_path)
 
-      # check G mean pattern for correctness
-      g_avg_for_caps = sum(g_means) / len(g_means)
-      g_high = [g / g_avg_for_caps > 1 for g in g_means]
-      if g_high != _PATTERN_CHECK:
-        raise AssertionError(f'G means: {g_means}, TEMPLATE: {_REQ_PATTERN}')
+      if not g_high_matches_pattern:
+        raise AssertionError(
+            f'G means: {g_means.tolist()}, TEMPLATE: {_REQ_PATTERN}')
 
 if __name__ == '__main__':
   test_runner.main()
@@ -17,8 +17,7 @@
 import logging
 import math
 import os.path
-import matplotlib
-from matplotlib import pylab
+from matplotlib import figure
 from mobly import test_runner
 import numpy as np
 
@@ -87,66 +86,73 @@ class RawSensitivityTest(its_base_test.ItsBaseTest):
       cfa_idxs = image_processing_utils.get_canonical_cfa_order(props)
       black_levels = image_processing_utils.get_black_levels(props)
       white_level = props['android.sensor.info.whiteLevel']
+      inv_white_level_sq = 1.0 / (float(white_level) ** 2)
+      # Capture in rawStats to reduce test run time
+      fmt = define_raw_stats_fmt(props)
 
+      # One request per sensitivity, repeated for each of its frames
       sensitivities = list(range(sens_min, sens_max, sens_step))
-      variances = []
-      for s in sensitivities:
-        e = int(s_e_prod / float(s))
-        req = capture_request_utils.manual_capture_request(s, e, 0)
-
-        # Capture in rawStats to reduce test run time
-        fmt = define_raw_stats_fmt(props)
-        caps = cam.do_capture([req]*_NUM_FRAMES, fmt)
-        image_processing_utils.assert_capture_width_and_height(
-            caps[0], _IMG_STATS_GRID, _IMG_STATS_GRID
-        )
-
-        # Measure mean & variance
-        for i, cap in enumerate(caps):
-          mean_img, var_img = image_processing_utils.unpack_rawstats_capture(
-              cap
-          )
-          mean = mean_img[_IMG_STATS_GRID//2, _IMG_STATS_GRID//2,
-                          cfa_idxs[_GR_PLANE_IDX]]
-          var = var_img[_IMG_STATS_GRID//2, _IMG_STATS_GRID//2,
-                        cfa_idxs[_GR_PLANE_IDX]]/white_level**2
+      exposures = (s_e_prod / np.asarray(sensitivities, dtype=np.float64)
+                   ).astype(np.int64).tolist()  # JSON needs Python ints
+      sens_reqs = [
+          capture_request_utils.manual_capture_request(s, e, 0)
+          for s, e in zip(sensitivities, exposures)]
+      reqs = [req for req in sens_reqs for _ in range(_NUM_FRAMES)]
+
+      # Capture all sensitivities in one batch
+      caps = cam.do_capture(reqs, fmt)
+      image_processing_utils.assert_capture_width_and_height(
+          caps[0], _IMG_STATS_GRID, _IMG_STATS_GRID
+      )
+
+      # Measure mean & variance of the center GR cell of all captures
+      center_stats = np.array([
+          image_processing_utils.unpack_rawstats_cell(
+              cap, _IMG_STATS_GRID//2, _IMG_STATS_GRID//2,
+              cfa_idxs[_GR_PLANE_IDX])
+          for cap in caps])
+      means = center_stats[:, 0]
+      variances = center_stats[:, 1] * inv_white_level_sq
+      if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for i, (mean, var) in enumerate(zip(means, variances)):
           logging.debug('cap: %d, mean: %.2f, var: %e', i, mean, var)
-          variances.append(var)
 
       # Flag dark images
+      mean = means[-1]
       if math.isclose(mean, max(black_levels), rel_tol=_BLACK_LEVEL_RTOL):
         raise AssertionError(f'Images are too dark! Center mean: {mean:.2f}')
 
       # Create plot
       sensitivities = np.repeat(sensitivities, _NUM_FRAMES)
-      pylab.figure(_NAME)
-      pylab.plot(sensitivities, variances, '-ro')
-      pylab.xticks(sensitivities)
-      pylab.xlabel('Sensitivities')
-      pylab.ylabel('Image Center Patch Variance')
-      pylab.ticklabel_format(axis='y', style='sci', scilimits=(-6, -6))
-      pylab.title(_NAME)
-      matplotlib.pyplot.savefig(f'{name_with_log_path}_variances.png')
+      fig = figure.Figure()
+      ax = fig.add_subplot()
+      ax.plot(sensitivities, variances, '-ro')
+      ax.set_xticks(sensitivities)
+      ax.set_xlabel('Sensitivities')
+      ax.set_ylabel('Image Center Patch Variance')
+      ax.ticklabel_format(axis='y', style='sci', scilimits=(-6, -6))
+      ax.set_title(_NAME)
+      fig.savefig(f'{name_with_log_path}_variances.png')
 
       # Find average variance at each step
-      vars_step_means = []
-      for i in range(_NUM_SENS_STEPS):
-        vars_step = []
-        for j in range(_NUM_FRAMES):
-          vars_step.append(variances[_NUM_FRAMES * i + j])
-        vars_step_means.append(np.mean(vars_step))
+      vars_step_means = np.asarray(
+          variances[:_NUM_SENS_STEPS * _NUM_FRAMES], dtype=np.float64
+      ).reshape(_NUM_SENS_STEPS, _NUM_FRAMES).mean(axis=1)
       logging.debug('averaged variances: %s', vars_step_means)
 
       # Assert each set of shots is noisier than previous and save img on FAIL
-      for variance_idx, variance in enumerate(vars_step_means[:-1]):
-        if variance >= vars_step_means[variance_idx+1] / _VAR_THRESH:
-          image_processing_utils.capture_scene_image(
-              cam, props, name_with_log_path
-          )
-          raise AssertionError(
-              f'variances [i]: {variances[variance_idx]:.5f}, '
-              f'[i+1]: {variances[variance_idx+1]:.5f}, THRESH: {_VAR_THRESH}'
-          )
+      not_noisier_idxs = np.flatnonzero(
+          vars_step_means[:-1] >= vars_step_means[1:] / _VAR_THRESH)
+      if not_noisier_idxs.size:
+        variance_idx = not_noisier_idxs[0]
+        image_processing_utils.capture_scene_image(
+            cam, props, name_with_log_path
+        )
+        raise AssertionError(
+            f'variances [i]: {variances[variance_idx]:.5f}, '
+            f'[i+1]: {variances[variance_idx+1]:.5f}, '
+            f'THRESH: {_VAR_THRESH}'
+        )
 
 if __name__ == '__main__':
   test_runner.main()
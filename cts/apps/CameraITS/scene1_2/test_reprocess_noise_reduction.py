@@ -17,8 +17,7 @@
 import logging
 import math
 import os.path
-import matplotlib
-from matplotlib import pylab
+from matplotlib import figure
 from mobly import test_runner
 import numpy as np
 
@@ -30,9 +29,11 @@ import its_session_utils
 import target_exposure_utils
 
 _COLORS = ('R', 'G', 'B')
+_COLOR_FMTS = tuple(f'-{color.lower()}o' for color in _COLORS)
 _NAME = os.path.splitext(os.path.basename(__file__))[0]
 _NR_MODES = {'OFF': 0, 'FAST': 1, 'HQ': 2, 'MIN': 3, 'ZSL': 4}
 _NR_MODES_LIST = tuple(_NR_MODES.values())
+_NR_MODES_XLABEL = str(_NR_MODES)[1:-1]  # strip '{' '}' off string
 _NUM_FRAMES = 2
 _PATCH_H = 0.1  # center 10%
 _PATCH_W = 0.1
@@ -41,25 +42,26 @@ _PATCH_Y = 0.5 - _PATCH_H/2
 _SNR_ATOL = 3  # unit in dB
 
 
-def calc_rgb_snr(cap, frame, nr_mode, name_with_log_path):
-  """Calculate the RGB SNRs from a capture center patch.
+def calc_rgb_means_and_stds(imgs):
+  """Calculate the RGB means and standard deviations of the center patches.
 
   Args:
-    cap: Camera capture object.
-    frame: Integer frame number.
-    nr_mode: Integer noise reduction mode index.
-    name_with_log_path: Test name with path for storage
+    imgs: List of decoded RGB images.
 
   Returns:
-    RGB SNRs.
+    Tuple of numpy arrays (means, stds), each with shape (len(imgs), 3).
   """
-  img = image_processing_utils.decompress_jpeg_to_rgb_image(cap)
-  if frame == 0:  # save 1st frame
-    image_processing_utils.write_image(
-        img, f'{name_with_log_path}_high_gain_nr={nr_mode}_fmt=jpg.jpg')
-  patch = image_processing_utils.get_image_patch(
-      img, _PATCH_X, _PATCH_Y, _PATCH_W, _PATCH_H)
-  return image_processing_utils.compute_image_snrs(patch)
+  patches = None
+  for i, img in enumerate(imgs):
+    patch = image_processing_utils.get_image_patch(
+        img, _PATCH_X, _PATCH_Y, _PATCH_W, _PATCH_H)
+    if patches is None:  # all frames share the 1st frame's patch shape
+      patches = np.empty((len(imgs),) + patch.shape, dtype=np.float32)
+    patches[i] = patch
+  # Two-pass variance: subtract the mean before squaring to avoid cancellation
+  means = patches.mean(axis=(1, 2), keepdims=True)
+  variances = np.square(patches - means).mean(axis=(1, 2))
+  return means.squeeze(axis=(1, 2)), np.sqrt(variances)
 
 
 def create_plot(snrs, reprocess_format, name_with_log_path):
@@ -70,15 +72,15 @@ def create_plot(snrs, reprocess_format, name_with_log_path):
     reprocess_format: String of 'yuv' or 'private'.
     name_with_log_path: Test name with path for storage.
   """
-  pylab.figure(reprocess_format)
-  for ch, color in enumerate(_COLORS):
-    pylab.plot(_NR_MODES_LIST, snrs[ch], f'-{color.lower()}o')
-  pylab.title(f'{_NAME} ({reprocess_format})')
-  pylab.xlabel(f'{str(_NR_MODES)[1:-1]}')  # strip '{' '}' off string
-  pylab.ylabel('SNR (dB)')
-  pylab.xticks(_NR_MODES_LIST)
-  matplotlib.pyplot.savefig(
-      f'{name_with_log_path}_plot_{reprocess_format}_SNRs.png')
+  fig = figure.Figure()
+  ax = fig.add_subplot()
+  for ch_snrs, color_fmt in zip(snrs, _COLOR_FMTS):
+    ax.plot(_NR_MODES_LIST, ch_snrs, color_fmt)
+  ax.set_title(f'{_NAME} ({reprocess_format})')
+  ax.set_xlabel(_NR_MODES_XLABEL)
+  ax.set_ylabel('SNR (dB)')
+  ax.set_xticks(_NR_MODES_LIST)
+  fig.savefig(f'{name_with_log_path}_plot_{reprocess_format}_SNRs.png')
 
 
 class ReprocessNoiseReductionTest(its_base_test.ItsBaseTest):
@@ -124,9 +126,14 @@ class ReprocessNoiseReductionTest(its_base_test.ItsBaseTest):
           cam, props, self.scene, self.tablet,
           its_session_utils.CHART_DISTANCE_NO_SCALING)
 
+      # Look up NR mode support once.
+      nr_modes_supported = {
+          nr_mode: camera_properties_utils.noise_reduction_mode(props, nr_mode)
+          for nr_mode in _NR_MODES_LIST}
+      min_mode_supported = nr_modes_supported[_NR_MODES['MIN']]
+
       # If reprocessing is supported, ZSL NR mode must be available.
-      if not camera_properties_utils.noise_reduction_mode(
-          props, _NR_MODES['ZSL']):
+      if not nr_modes_supported[_NR_MODES['ZSL']]:
         raise KeyError('Reprocessing supported, so ZSL must be supported.')
 
       reprocess_formats = []
@@ -143,37 +150,61 @@ class ReprocessNoiseReductionTest(its_base_test.ItsBaseTest):
         snrs = [[], [], []]
         nr_modes_reported = []
 
-        # Capture for each mode.
+        # Capture all supported modes in one batch.
         exp, sens = target_exposure_utils.get_target_exposure_combos(
             log_path, cam)['maxSensitivity']
+        reqs = []
+        for nr_mode in _NR_MODES_LIST:
+          if nr_modes_supported[nr_mode]:
+            req = capture_request_utils.manual_capture_request(sens, exp)
+            req['android.noiseReduction.mode'] = nr_mode
+            reqs.extend([req]*_NUM_FRAMES)
+        caps = cam.do_capture(reqs, out_surface, reprocess_format)
+
+        # Measure center patches of each supported mode's caps.
+        rgb_means = {}
+        rgb_stds = {}
+        caps_idx = 0
+        for nr_mode in _NR_MODES_LIST:
+          if nr_modes_supported[nr_mode]:
+            mode_caps = caps[caps_idx:caps_idx + _NUM_FRAMES]
+            # Save 1st frame as captured instead of re-encoding decoded image
+            img_name = (
+                f'{name_with_log_path}_high_gain_nr={nr_mode}_fmt=jpg.jpg')
+            with open(img_name, 'wb') as f:
+              f.write(mode_caps[0]['data'])
+            imgs = [
+                image_processing_utils.decompress_jpeg_to_rgb_image(
+                    cap['data']) for cap in mode_caps]
+            rgb_means[nr_mode], rgb_stds[nr_mode] = calc_rgb_means_and_stds(
+                imgs)
+            caps_idx += _NUM_FRAMES
+
+        # Convert to SNRs (dB) for all modes at once.
+        rgb_snrs = dict(zip(rgb_means, 20 * np.log10(
+            np.array(list(rgb_means.values())) /
+            np.array(list(rgb_stds.values())))))
+
         for nr_mode in _NR_MODES_LIST:
           # Skip unavailable modes
-          if not camera_properties_utils.noise_reduction_mode(props, nr_mode):
+          if not nr_modes_supported[nr_mode]:
             nr_modes_reported.append(nr_mode)
             for ch, _ in enumerate(_COLORS):
               snrs[ch].append(0)
             continue
 
-          # Create req, do caps and calc center SNRs.
-          rgb_snr_list = []
           nr_modes_reported.append(nr_mode)
-          req = capture_request_utils.manual_capture_request(sens, exp)
-          req['android.noiseReduction.mode'] = nr_mode
-          caps = cam.do_capture(
-              [req]*_NUM_FRAMES, out_surface, reprocess_format)
-          for i in range(_NUM_FRAMES):
-            rgb_snr_list.append(calc_rgb_snr(caps[i]['data'], i, nr_mode,
-                                             name_with_log_path))
-
-          r_snrs = [rgb[0] for rgb in rgb_snr_list]
-          g_snrs = [rgb[1] for rgb in rgb_snr_list]
-          b_snrs = [rgb[2] for rgb in rgb_snr_list]
-          rgb_avg_snrs = [np.mean(r_snrs), np.mean(g_snrs), np.mean(b_snrs)]
-          for ch, x_snrs in enumerate([r_snrs, g_snrs, b_snrs]):
-            snrs[ch].append(rgb_avg_snrs[ch])
-            logging.debug(
-                'NR mode %d %s SNR avg: %.2f min: %.2f, max: %.2f', nr_mode,
-                _COLORS[ch], rgb_avg_snrs[ch], min(x_snrs), max(x_snrs))
+          rgb_snr_list = rgb_snrs[nr_mode]
+          rgb_avg_snrs = rgb_snr_list.mean(axis=0)
+          for ch, avg_snr in enumerate(rgb_avg_snrs):
+            snrs[ch].append(avg_snr)
+          if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for color, avg_snr, min_snr, max_snr in zip(
+                _COLORS, rgb_avg_snrs, rgb_snr_list.min(axis=0),
+                rgb_snr_list.max(axis=0)):
+              logging.debug(
+                  'NR mode %d %s SNR avg: %.2f min: %.2f, max: %.2f', nr_mode,
+                  color, avg_snr, min_snr, max_snr)
 
         # Plot data.
         create_plot(snrs, reprocess_format, name_with_log_path)
@@ -200,8 +231,7 @@ class ReprocessNoiseReductionTest(its_base_test.ItsBaseTest):
             raise AssertionError(f'HQ: {snrs[j][_NR_MODES["HQ"]]:.2f}, '
                                  f'OFF: {snrs[j][_NR_MODES["OFF"]]:.2f}')
 
-          if camera_properties_utils.noise_reduction_mode(
-              props, _NR_MODES['MIN']):
+          if min_mode_supported:
             # OFF < MIN + ATOL
             if snrs[j][_NR_MODES['OFF']] >= snrs[j][_NR_MODES['MIN']]+_SNR_ATOL:
               raise AssertionError(f'MIN: {snrs[j][_NR_MODES["MIN"]]:.2f}, '
@@ -12,12 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import functools
 import glob
 import json
 import logging
 import os
 import os.path
 import re
+import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -30,7 +34,6 @@ import image_processing_utils
 import its_device_utils
 import its_session_utils
 import lighting_control_utils
-import numpy as np
 import yaml
 
 
@@ -40,8 +43,10 @@ TEST_KEY_TABLET = 'tablet'
 TEST_KEY_SENSOR_FUSION = 'sensor_fusion'
 ACTIVITY_START_WAIT = 1.5  # seconds
 MERGE_RESULTS_TIMEOUT = 3600  # seconds
+MERGE_RESULTS_POLL_INTERVAL = 0.5  # seconds
 
 NUM_TRIES = 2
+TEST_OUTPUT_BUFSIZE = 65536  # bytes read from a test's output pipe at a time
 RESULT_PASS = 'PASS'
 RESULT_FAIL = 'FAIL'
 RESULT_NOT_EXECUTED = 'NOT_EXECUTED'
@@ -63,9 +68,28 @@ _FRONT_CAMERA_ID = '1'
 # recover replaced '_' in scene def
 _INT_STR_DICT = types.MappingProxyType({'11': '1_1', '12': '1_2'})
 _MAIN_TESTBED = 0
+_MAX_PARSE_WORKERS = 32
 _PROPERTIES_TO_MATCH = (
     'ro.product.model', 'ro.product.name', 'ro.build.display.id', 'ro.revision'
 )
+# Use the libyaml C bindings when PyYAML was built with them
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
+# Command line arguments of the form 'name=value'
+_ARG_PATTERN = re.compile(r'^(scenes|camera|testbed_index|num_testbeds)=(.*)$')
+# Result files written by write_result for each testbed and camera
+_TESTBED_FILE_PATTERN = re.compile(r'^testbed_(\d+)_camera_.*\.tmp$')
+# Marker files written by each testbed once it has finished
+_COMPLETED_TESTBED_FILE_PATTERN = re.compile(r'^testbed_(\d+)_completed\.tmp$')
+# Mobly summary lines parsed after each test. The MPC and gainmap prefixes
+# must match MPC12_CAMERA_LAUNCH_PATTERN, MPC12_JPEG_CAPTURE_PATTERN, and the
+# gainmap pattern in ItsTestActivity.java.
+_MPC_LINE_PREFIXES = ('1080p_jpeg_capture_time_ms:', 'camera_launch_time_ms:')
+_GAINMAP_LINE_PREFIX = 'has_gainmap:'
+_PERF_METRICS_LINE_PREFIX = 'test'
+_PERF_METRICS_LINE_PATTERN = re.compile('test.*:')
+# '[name]: [value]' lines of 'adb shell getprop' output
+_GETPROP_LINE_PATTERN = re.compile(r'^\[([^\]]+)\]: \[([^\]]*)\]', re.M)
 
 # Scenes that can be automated through tablet display
 # Notes on scene names:
@@ -99,6 +123,7 @@ _EXTENSIONS_SCENES = (os.path.join('scene_extensions', 'scene_hdr'),
 
 # All possible scenes
 _ALL_SCENES = _TABLET_SCENES + _MANUAL_SCENES + _MOTION_SCENES + _FLASH_SCENES
+_ALL_SCENES_FOLDED = tuple(f'{s}_folded' for s in _ALL_SCENES)
 
 # Scenes that are logically grouped and can be called as group
 _GROUPED_SCENES = types.MappingProxyType({
@@ -205,8 +230,11 @@ _EXTENSION_NAMES = (
     'hdr',
     'low_light',
 )
+_SCENE_EXTENSION_NAMES = tuple(f'scene_{e}' for e in _EXTENSION_NAMES)
 
 _DST_SCENE_DIR = '/sdcard/Download/'
+# Skip operator prompts and accept manual scenes as set up, for automated runs
+_NON_INTERACTIVE = os.environ.get('ITS_NON_INTERACTIVE') == '1'
 _SUB_CAMERA_LEVELS = 2
 MOBLY_TEST_SUMMARY_TXT_FILE = 'test_mobly_summary.txt'
 
@@ -220,27 +248,41 @@ def report_result(device_id, camera_id, results):
    results: a dictionary contains all ITS scenes as key and result/summary of
             current ITS run. See test_report_result unit test for an example.
   """
-  adb = f'adb -s {device_id}'
   its_device_utils.start_its_test_activity(device_id)
   time.sleep(ACTIVITY_START_WAIT)
 
-  # Validate/process results argument
-  for scene in results:
-    if RESULT_KEY not in results[scene]:
-      raise ValueError(f'ITS result not found for {scene}')
-    if results[scene][RESULT_KEY] not in RESULT_VALUES:
-      raise ValueError(f'Unknown ITS result for {scene}: {results[RESULT_KEY]}')
-    if SUMMARY_KEY in results[scene]:
-      device_summary_path = f'/sdcard/its_camera{camera_id}_{scene}.txt'
-      its_device_utils.run(
-          f'{adb} push {results[scene][SUMMARY_KEY]} {device_summary_path}')
-      results[scene][SUMMARY_KEY] = device_summary_path
+  # Validate/process results argument, staging summaries for a single push
+  with tempfile.TemporaryDirectory() as summary_dir:
+    for scene in results:
+      if RESULT_KEY not in results[scene]:
+        raise ValueError(f'ITS result not found for {scene}')
+      if results[scene][RESULT_KEY] not in RESULT_VALUES:
+        raise ValueError(
+            f'Unknown ITS result for {scene}: {results[RESULT_KEY]}')
+      if SUMMARY_KEY in results[scene]:
+        summary_name = f'its_camera{camera_id}_{scene}.txt'
+        staged_summary_path = os.path.join(summary_dir, summary_name)
+        # scene_extensions scenes put their summaries in a subdirectory
+        os.makedirs(os.path.dirname(staged_summary_path), exist_ok=True)
+        shutil.copyfile(results[scene][SUMMARY_KEY], staged_summary_path)
+        results[scene][SUMMARY_KEY] = f'/sdcard/{summary_name}'
+    staged_entries = sorted(os.listdir(summary_dir))
+    if staged_entries:
+      subprocess.check_call(
+          ['adb', '-s', device_id, 'push'] +
+          [os.path.join(summary_dir, e) for e in staged_entries] +
+          ['/sdcard/'],
+          stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
 
   json_results = json.dumps(results)
-  cmd = (f"{adb} shell am broadcast -a {ACTION_ITS_RESULT} --es {EXTRA_VERSION}"
-         f" {CURRENT_ITS_VERSION} --es {EXTRA_CAMERA_ID} {camera_id} --es "
-         f"{EXTRA_RESULTS} \'{json_results}\'")
-  its_device_utils.run(cmd)
+  # Quote the results once for the device shell, which re-parses the command
+  cmd = ['adb', '-s', device_id, 'shell', 'am', 'broadcast',
+         '-a', ACTION_ITS_RESULT,
+         '--es', EXTRA_VERSION, CURRENT_ITS_VERSION,
+         '--es', EXTRA_CAMERA_ID, camera_id,
+         '--es', EXTRA_RESULTS, shlex.quote(json_results)]
+  subprocess.check_call(
+      cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
 
 
 def write_result(testbed_index, device_id, camera_id, results):
@@ -259,6 +301,26 @@ def write_result(testbed_index, device_id, camera_id, results):
     json.dump(result, f)
 
 
+def _read_testbed_file(file_name):
+  """Reads a testbed result file written by write_result.
+
+  Args:
+    file_name: the name of a testbed_*_camera_*.tmp file.
+  Returns:
+    Tuple of device_id, camera_id, and results of the testbed's run.
+  """
+  camera_id = file_name.split('camera_')[1].split('.tmp')[0]
+  device_id = ''
+  results = {}
+  with open(file_name, 'r') as f:
+    testbed_data = json.load(f)
+    device_id = testbed_data['device_id']
+    results = testbed_data['results']
+  if not device_id or not results:
+    raise ValueError(f'device_id or results for {file_name} not found.')
+  return device_id, camera_id, results
+
+
 def parse_testbeds(completed_testbeds):
   """Parses completed testbeds and yields device_id, camera_id, and results.
 
@@ -269,20 +331,25 @@ def parse_testbeds(completed_testbeds):
     camera_id: one of the camera_ids associated with the testbed.
     results: the dictionary with scenes and result/summary of testbed's run.
   """
-  for i in completed_testbeds:
-    for file_name in glob.glob(f'testbed_{i}_camera_*.tmp'):
-      camera_id = file_name.split('camera_')[1].split('.tmp')[0]
-      device_id = ''
-      results = {}
-      with open(file_name, 'r') as f:
-        testbed_data = json.load(f)
-        device_id = testbed_data['device_id']
-        results = testbed_data['results']
-      if not device_id or not results:
-        raise ValueError(f'device_id or results for {file_name} not found.')
-      yield device_id, camera_id, results
-
-
+  completed_testbeds = set(completed_testbeds)
+  # List the directory once for the files of all completed testbeds
+  file_names = []
+  with os.scandir('.') as entries:
+    for entry in entries:
+      file_match = _TESTBED_FILE_PATTERN.match(entry.name)
+      if file_match and int(file_match.group(1)) in completed_testbeds:
+        file_names.append(entry.name)
+  file_names.sort()
+  if not file_names:
+    return
+  # Read and decode all files concurrently, keeping testbed/camera order
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=min(_MAX_PARSE_WORKERS, len(file_names))) as executor:
+    parsed_testbeds = list(executor.map(_read_testbed_file, file_names))
+  yield from parsed_testbeds
+
+
+@functools.lru_cache(maxsize=None)
 def get_device_property(device_id, property_name):
   """Get property of a given device.
 
@@ -292,12 +359,26 @@ def get_device_property(device_id, property_name):
   Returns:
     The value of the property.
   """
-  property_cmd = f'adb -s {device_id} shell getprop {property_name}'
   raw_output = subprocess.check_output(
-      property_cmd, stderr=subprocess.STDOUT, shell=True)
+      ['adb', '-s', device_id, 'shell', 'getprop', property_name],
+      stderr=subprocess.STDOUT)
   return str(raw_output.decode('utf-8')).strip()
 
 
+@functools.lru_cache(maxsize=None)
+def get_device_properties(device_id):
+  """Get all properties of a given device with a single getprop call.
+
+  Args:
+    device_id: the ID string of a device.
+  Returns:
+    A dict of property names to values.
+  """
+  raw_output = subprocess.check_output(
+      ['adb', '-s', device_id, 'shell', 'getprop'], stderr=subprocess.STDOUT)
+  return dict(_GETPROP_LINE_PATTERN.findall(raw_output.decode('utf-8')))
+
+
 def are_devices_similar(device_id_1, device_id_2):
   """Checks if key dimensions are the same between devices.
 
@@ -307,9 +388,14 @@ def are_devices_similar(device_id_1, device_id_2):
   Returns:
     True if both devices share key dimensions.
   """
+  if device_id_1 == device_id_2:
+    return True
+  properties_1 = get_device_properties(device_id_1)
+  properties_2 = get_device_properties(device_id_2)
   for property_to_match in _PROPERTIES_TO_MATCH:
-    property_value_1 = get_device_property(device_id_1, property_to_match)
-    property_value_2 = get_device_property(device_id_2, property_to_match)
+    # getprop returns an empty string for properties that are not set
+    property_value_1 = properties_1.get(property_to_match, '')
+    property_value_2 = properties_2.get(property_to_match, '')
     if property_value_1 != property_value_2:
       logging.error('%s does not match %s for %s',
                     property_value_1, property_value_2, property_to_match)
@@ -341,8 +427,10 @@ def check_manual_scenes(device_id, camera_id, scene, out_path):
     props = cam.override_with_hidden_physical_camera_props(props)
 
     while True:
-      input(f'\n Press <ENTER> after positioning camera {camera_id} with '
-            f'{scene}.\n The scene setup should be: \n  {_SCENE_REQ[scene]}\n')
+      if not _NON_INTERACTIVE:
+        input(f'\n Press <ENTER> after positioning camera {camera_id} with '
+              f'{scene}.\n The scene setup should be: \n  {_SCENE_REQ[scene]}'
+              '\n')
       # Converge 3A prior to capture
       if scene == 'scene5':
         cam.do_3a(do_af=False, lock_ae=camera_properties_utils.ae_lock(props),
@@ -356,6 +444,8 @@ def check_manual_scenes(device_id, camera_id, scene, out_path):
       img_name = os.path.join(out_path, f'test_{scene.replace("/", "_")}.jpg')
       logging.info('Please check scene setup in %s', img_name)
       image_processing_utils.write_image(img, img_name)
+      if _NON_INTERACTIVE:
+        break
       choice = input(f'Is the image okay for ITS {scene}? (Y/N)').lower()
       if choice == 'y':
         break
@@ -371,7 +461,7 @@ def get_config_file_contents():
     config_file_contents: a dict read from config.yml
   """
   with open(CONFIG_FILE) as file:
-    config_file_contents = yaml.safe_load(file)
+    config_file_contents = yaml.load(file, Loader=_YAML_LOADER)
   return config_file_contents
 
 
@@ -391,6 +481,22 @@ def get_test_params(config_file_contents):
   return test_params
 
 
+def _build_serial_map(config_file_contents):
+  """Returns a dict of device label to serial number from the config file.
+
+  Args:
+    config_file_contents: dict read from config.yml file
+  """
+  serial_map = {}
+  for datadict in config_file_contents['TestBeds']:
+    android_device_contents = datadict.get('Controllers')
+    for device_dict in android_device_contents.get('AndroidDevice'):
+      for label in device_dict.values():
+        if label in ('dut', 'tablet'):
+          serial_map[label] = str(device_dict.get('serial'))
+  return serial_map
+
+
 def get_device_serial_number(device, config_file_contents):
   """Returns the serial number of the device with label from the config file.
 
@@ -403,20 +509,7 @@ def get_device_serial_number(device, config_file_contents):
     device: String device label as specified in config file.dut/tablet
     config_file_contents: dict read from config.yml file
   """
-
-  for _, j in config_file_contents.items():
-    for datadict in j:
-      android_device_contents = datadict.get('Controllers')
-      for device_dict in android_device_contents.get('AndroidDevice'):
-        for _, label in device_dict.items():
-          if label == 'tablet':
-            tablet_device_id = str(device_dict.get('serial'))
-          if label == 'dut':
-            dut_device_id = str(device_dict.get('serial'))
-  if device == 'tablet':
-    return tablet_device_id
-  else:
-    return dut_device_id
+  return _build_serial_map(config_file_contents)[device]
 
 
 def get_updated_yml_file(yml_file_contents):
@@ -436,7 +529,8 @@ def get_updated_yml_file(yml_file_contents):
       suffix='.yml', prefix='config_', dir=YAML_FILE_DIR)
   os.close(file_descriptor)
   with open(new_yaml_file, 'w') as f:
-    yaml.dump(yml_file_contents, stream=f, default_flow_style=False)
+    yaml.dump(yml_file_contents, stream=f, Dumper=_YAML_DUMPER,
+              default_flow_style=False)
   new_yaml_file_name = os.path.basename(new_yaml_file)
   return new_yaml_file_name
 
@@ -453,15 +547,18 @@ def enable_external_storage(device_id):
   its_device_utils.run(cmd)
 
 
-def get_available_cameras(device_id, camera_id):
-  """Get available camera devices in the current state.
+def get_camera_availability(device_id, camera_id):
+  """Get available and unavailable cameras in the current state.
+
+  Both lists are read from a single ItsSession.
 
   Args:
     device_id: Serial number of the device.
-    camera_id: Logical camera_id
+    camera_id: Logical camera device id
 
   Returns:
-    List of all the available camera_ids.
+    Tuple of lists of all the available camera_ids and all the unavailable
+    physical camera_ids.
   """
   with its_session_utils.ItsSession(
       device_id=device_id,
@@ -481,7 +578,22 @@ def get_available_cameras(device_id, camera_id):
       if i in all_camera_ids:
         all_camera_ids.remove(i)
     logging.debug('available camera ids: %s', all_camera_ids)
-  return all_camera_ids
+    logging.debug('Unavailable physical camera ids: %s',
+                  unavailable_physical_ids)
+  return all_camera_ids, unavailable_physical_ids
+
+
+def get_available_cameras(device_id, camera_id):
+  """Get available camera devices in the current state.
+
+  Args:
+    device_id: Serial number of the device.
+    camera_id: Logical camera_id
+
+  Returns:
+    List of all the available camera_ids.
+  """
+  return get_camera_availability(device_id, camera_id)[0]
 
 
 def get_unavailable_physical_cameras(device_id, camera_id):
@@ -494,18 +606,7 @@ def get_unavailable_physical_cameras(device_id, camera_id):
   Returns:
     List of all the unavailable camera_ids.
   """
-  with its_session_utils.ItsSession(
-      device_id=device_id,
-      camera_id=camera_id) as cam:
-    unavailable_physical_cameras = cam.get_unavailable_physical_cameras(
-        camera_id)
-    unavailable_physical_ids = unavailable_physical_cameras[
-        'unavailablePhysicalCamerasArray']
-    unavailable_physical_ids = [f'{camera_id}.{s}'
-                                for s in unavailable_physical_ids]
-    logging.debug('Unavailable physical camera ids: %s',
-                  unavailable_physical_ids)
-  return unavailable_physical_ids
+  return get_camera_availability(device_id, camera_id)[1]
 
 
 def is_device_folded(device_id):
@@ -514,8 +615,10 @@ def is_device_folded(device_id):
   Args:
     device_id: Serial number of the foldable device.
   """
-  cmd = (f'adb -s {device_id} shell cmd device_state state')
-  result = subprocess.getoutput(cmd)
+  result = subprocess.run(
+      ['adb', '-s', device_id, 'shell', 'cmd', 'device_state', 'state'],
+      stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+      check=False).stdout
   if 'CLOSE' in result:
     return True
   return False
@@ -544,10 +647,16 @@ def main():
                  multiple scenes. Ex: "scenes=scene0,scene1_1" or
                  "scenes=0,1_1,sensor_fusion" (sceneX can be abbreviated by X
                  where X is scene name minus 'scene')
+
+    Environment variables:
+        ITS_NON_INTERACTIVE: set to 1 to skip operator prompts and accept
+                             manual scene setups without confirmation.
   """
   logging.basicConfig(level=logging.INFO)
   # Make output directories to hold the generated files.
   topdir = tempfile.mkdtemp(prefix='CameraITS_')
+  mobly_summary_path = os.path.join(topdir, MOBLY_TEST_SUMMARY_TXT_FILE)
+  camera_its_top = os.environ['CAMERA_ITS_TOP']
   try:
     subprocess.call(['chmod', 'g+rx', topdir])
   except OSError as e:
@@ -558,17 +667,19 @@ def main():
   testbed_index = None
   num_testbeds = None
   # Override camera, scenes and testbed with cmd line values if available
-  for s in list(sys.argv[1:]):
-    if 'scenes=' in s:
-      scenes = s.split('=')[1].split(',')
-    elif 'camera=' in s:
-      camera_id_combos = s.split('=')[1].split(',')
-    elif 'testbed_index=' in s:
-      testbed_index = int(s.split('=')[1])
-    elif 'num_testbeds=' in s:
-      num_testbeds = int(s.split('=')[1])
-    else:
+  for s in sys.argv[1:]:
+    arg_match = _ARG_PATTERN.match(s)
+    if not arg_match:
       raise ValueError(f'Unknown argument {s}')
+    arg_name, arg_value = arg_match.groups()
+    if arg_name == 'scenes':
+      scenes = arg_value.split(',')
+    elif arg_name == 'camera':
+      camera_id_combos = arg_value.split(',')
+    elif arg_name == 'testbed_index':
+      testbed_index = int(arg_value)
+    else:
+      num_testbeds = int(arg_value)
   if testbed_index is None and num_testbeds is not None:
     raise ValueError(
         'testbed_index must be specified if num_testbeds is specified.')
@@ -583,28 +694,26 @@ def main():
         not s.startswith(('checkerboard', 'sensor_fusion',
                           'flash', 'feature_combination', '<scene-name>'))):
       scenes[i] = f'scene{s}'
-    if s.startswith('flash') or s.startswith('extensions'):
+    if s.startswith(('flash', 'extensions')):
       scenes[i] = f'scene_{s}'
     # Handle scene_extensions
-    if any(s.startswith(extension) for extension in _EXTENSION_NAMES):
+    if s.startswith(_EXTENSION_NAMES):
       scenes[i] = f'scene_extensions/scene_{s}'
-    if (any(s.startswith('scene_' + extension)
-            for extension in _EXTENSION_NAMES)):
+    if s.startswith(_SCENE_EXTENSION_NAMES):
       scenes[i] = f'scene_extensions/{s}'
 
   # Read config file and extract relevant TestBed
   config_file_contents = get_config_file_contents()
   if testbed_index is None:
-    for i in config_file_contents['TestBeds']:
-      if scenes in (
-          ['sensor_fusion'], ['checkerboard'], ['scene_flash'],
-          ['feature_combination']
-      ):
-        if TEST_KEY_SENSOR_FUSION not in i['Name'].lower():
-          config_file_contents['TestBeds'].remove(i)
-      else:
-        if TEST_KEY_SENSOR_FUSION in i['Name'].lower():
-          config_file_contents['TestBeds'].remove(i)
+    # Keep only sensor_fusion testbeds for rig scenes, and only others if not
+    want_sensor_fusion = scenes in (
+        ['sensor_fusion'], ['checkerboard'], ['scene_flash'],
+        ['feature_combination']
+    )
+    config_file_contents['TestBeds'] = [
+        i for i in config_file_contents['TestBeds']
+        if (TEST_KEY_SENSOR_FUSION in i['Name'].lower()) == want_sensor_fusion
+    ]
   else:
     config_file_contents = {
         'TestBeds': [config_file_contents['TestBeds'][testbed_index]]
@@ -618,7 +727,8 @@ def main():
     scenes = str(test_params_content['scene']).split(',')
     scenes = [_INT_STR_DICT.get(n, n) for n in scenes]  # recover '1_1' & '1_2'
 
-  device_id = get_device_serial_number('dut', config_file_contents)
+  serial_map = _build_serial_map(config_file_contents)
+  device_id = serial_map['dut']
   # Enable external storage on DUT to send summary report to CtsVerifier.apk
   enable_external_storage(device_id)
 
@@ -631,23 +741,22 @@ def main():
   testing_foldable_device = True if test_params_content[
       'foldable_device'] == 'True' else False
   available_camera_ids_to_test_foldable = []
+  unav_cameras = []
   if testing_foldable_device:
     logging.debug('Testing foldable device.')
     # Check the state of foldable device. True if device is folded,
     # false if the device is opened.
     device_folded = is_device_folded(device_id)
-    # list of available camera_ids to be tested in device state
-    available_camera_ids_to_test_foldable = get_available_cameras(
-        device_id, _FRONT_CAMERA_ID)
+    # list of available camera_ids to be tested in device state, and
+    # unavailable camera_ids that should not be tested in device state.
+    available_camera_ids_to_test_foldable, unav_cameras = (
+        get_camera_availability(device_id, _FRONT_CAMERA_ID))
 
   config_file_test_key = config_file_contents['TestBeds'][0]['Name'].lower()
   logging.info('Saving %s output files to: %s', config_file_test_key, topdir)
   if TEST_KEY_TABLET in config_file_test_key:
-    tablet_id = get_device_serial_number('tablet', config_file_contents)
-    tablet_name_cmd = f'adb -s {tablet_id} shell getprop ro.product.device'
-    raw_output = subprocess.check_output(
-        tablet_name_cmd, stderr=subprocess.STDOUT, shell=True)
-    tablet_name = str(raw_output.decode('utf-8')).strip()
+    tablet_id = serial_map['tablet']
+    tablet_name = get_device_property(tablet_id, 'ro.product.device')
     logging.debug('Tablet name: %s', tablet_name)
     brightness = test_params_content['brightness']
     its_session_utils.validate_tablet(tablet_name, brightness, tablet_id)
@@ -664,10 +773,16 @@ def main():
       'manual' not in config_file_test_key):
     testing_flash_with_controller = True
 
+  # Without a lighting controller, or with an operator at the terminal, any
+  # test may prompt for <ENTER> (e.g. lighting_control_utils), so stream
+  # test output to echo it
+  operator_may_be_prompted = (not testing_flash_with_controller or
+                              sys.stdin.isatty())
+
   # Expand GROUPED_SCENES and remove any duplicates
-  scenes = [_GROUPED_SCENES[s] if s in _GROUPED_SCENES else s for s in scenes]
-  scenes = np.hstack(scenes).tolist()
-  scenes = sorted(set(scenes), key=scenes.index)
+  scenes = [grouped_scene for s in scenes
+            for grouped_scene in _GROUPED_SCENES.get(s, (s,))]
+  scenes = list(dict.fromkeys(scenes))
   # List of scenes to be executed in folded state will have '_folded'
   # prefix. This will help distinguish the test results from folded vs
   # open device state for front camera_ids.
@@ -685,18 +800,29 @@ def main():
     auto_scene_switch = False
     logging.info('Manual, checkerboard scenes, or scene5 testing.')
 
-  folded_prompted = False
-  opened_prompted = False
+  # Scenes that can be run, for logical cameras and for sub-cameras
+  if 'checkerboard' in scenes:
+    camera_possible_scenes = _CHECKERBOARD_SCENES
+  elif 'scene_flash' in scenes:
+    camera_possible_scenes = _FLASH_SCENES
+  elif 'scene_extensions' in scenes:
+    camera_possible_scenes = _EXTENSIONS_SCENES
+  else:
+    camera_possible_scenes = (
+        _TABLET_SCENES if auto_scene_switch else _ALL_SCENES)
+  sub_camera_possible_scenes = list(SUB_CAMERA_TESTS.keys())
+  if auto_scene_switch:
+    sub_camera_possible_scenes.remove('sensor_fusion')
+  run_all_possible_scenes = ('<scene-name>' in scenes or
+                             'checkerboard' in scenes or
+                             'scene_extensions' in scenes)
+
+  prompted_states = set()
+  # Cameras are tested one at a time: the DUT's ItsService serves a single
+  # session on REMOTE_PORT, the tablet shows one scene at a time, and manual
+  # scenes need the operator. Use separate testbeds to parallelize runs.
   for camera_id in camera_id_combos:
     test_params_content['camera'] = camera_id
-    results = {}
-    unav_cameras = []
-    # Get the list of unavailable cameras in current device state.
-    # These camera_ids should not be tested in current device state.
-    if testing_foldable_device:
-      unav_cameras = get_unavailable_physical_cameras(
-          device_id, _FRONT_CAMERA_ID)
-
     if testing_foldable_device:
       device_state = 'folded' if device_folded else 'opened'
 
@@ -713,39 +839,25 @@ def main():
           f'Camera {camera_id} is unavailable in device state {device_state}'
           f' and cannot be tested with device {device_state}!')
 
-    if (testing_folded_front_camera and camera_id not in unav_cameras
-        and not folded_prompted):
-      folded_prompted = True
-      input('\nYou are testing a foldable device in folded state. '
-            'Please make sure the device is folded and press <ENTER> '
-            'after positioning properly.\n')
-
-    if (testing_foldable_device and
-        not device_folded and _FRONT_CAMERA_ID in camera_id and
-        camera_id not in unav_cameras and not opened_prompted):
-      opened_prompted = True
-      input('\nYou are testing a foldable device in opened state. '
-            'Please make sure the device is unfolded and press <ENTER> '
-            'after positioning properly.\n')
+    # Prompt once per device state before testing its front cameras
+    if (testing_foldable_device and _FRONT_CAMERA_ID in camera_id and
+        camera_id not in unav_cameras and
+        device_state not in prompted_states):
+      prompted_states.add(device_state)
+      if not _NON_INTERACTIVE:
+        input(f'\nYou are testing a foldable device in {device_state} state. '
+              'Please make sure the device is '
+              f'{"folded" if device_folded else "unfolded"} and press '
+              '<ENTER> after positioning properly.\n')
 
     # Run through all scenes if user does not supply one and config file doesn't
     # have specific scene name listed.
     if its_session_utils.SUB_CAMERA_SEPARATOR in camera_id:
-      possible_scenes = list(SUB_CAMERA_TESTS.keys())
-      if auto_scene_switch:
-        possible_scenes.remove('sensor_fusion')
+      possible_scenes = sub_camera_possible_scenes
     else:
-      if 'checkerboard' in scenes:
-        possible_scenes = _CHECKERBOARD_SCENES
-      elif 'scene_flash' in scenes:
-        possible_scenes = _FLASH_SCENES
-      elif 'scene_extensions' in scenes:
-        possible_scenes = _EXTENSIONS_SCENES
-      else:
-        possible_scenes = _TABLET_SCENES if auto_scene_switch else _ALL_SCENES
+      possible_scenes = camera_possible_scenes
 
-    if ('<scene-name>' in scenes or 'checkerboard' in scenes or
-        'scene_extensions' in scenes):
+    if run_all_possible_scenes:
       per_camera_scenes = possible_scenes
     else:
       # Validate user input scene names
@@ -772,18 +884,17 @@ def main():
     logging.info('camera: %s, scene(s): %s', camera_id, per_camera_scenes)
 
     if testing_folded_front_camera:
-      all_scenes = [f'{s}_folded' for s in _ALL_SCENES]
+      all_scenes = _ALL_SCENES_FOLDED
     else:
       all_scenes = _ALL_SCENES
 
-    for s in all_scenes:
-      results[s] = {RESULT_KEY: RESULT_NOT_EXECUTED}
+    results = {s: {RESULT_KEY: RESULT_NOT_EXECUTED} for s in all_scenes}
 
-      # assert device folded testing scenes with suffix 'folded'
-      if testing_foldable_device and 'folded' in s:
-        if not device_folded:
-          raise AssertionError('Device should be folded during'
-                               ' testing scenes with suffix "folded"')
+    # assert device folded testing scenes with suffix 'folded'
+    if (testing_foldable_device and not device_folded and
+        any('folded' in s for s in all_scenes)):
+      raise AssertionError('Device should be folded during'
+                           ' testing scenes with suffix "folded"')
 
     # A subdir in topdir will be created for each camera_id. All scene test
     # output logs for each camera id will be stored in this subdir.
@@ -800,7 +911,7 @@ def main():
       results[s][PERFORMANCE_KEY] = []
 
       # unit is millisecond for execution time record in CtsVerifier
-      scene_start_time = int(round(time.time() * 1000))
+      scene_start_time = time.time_ns() // 1_000_000
       scene_test_summary = f'Cam{camera_id} {s}' + '\n'
       mobly_scene_output_logs_path = os.path.join(mobly_output_logs_path, s)
 
@@ -824,7 +935,24 @@ def main():
           check_manual_scenes(device_id, camera_id, testing_scene,
                               mobly_output_logs_path)
 
-      scene_test_list = []
+      scene_tests_dir = os.path.join(camera_its_top, 'tests', testing_scene)
+      if camera_id.rfind(its_session_utils.SUB_CAMERA_SEPARATOR) == -1:
+        with os.scandir(scene_tests_dir) as scene_dir:
+          scene_test_list = [
+              entry.name for entry in scene_dir
+              if entry.name.endswith('.py') and 'test' in entry.name]
+      else:  # sub-camera
+        if SUB_CAMERA_TESTS.get(testing_scene):
+          scene_test_list = [f'{test}.py' for test in SUB_CAMERA_TESTS[
+              testing_scene]]
+        else:
+          scene_test_list = []
+      scene_test_list.sort()
+      if not scene_test_list:
+        # Nothing to run, so skip writing and removing a config file.
+        logging.info('No tests for %s', testing_scene)
+        continue
+
       config_file_contents['TestBeds'][0]['TestParams'] = test_params_content
       # Add the MoblyParams to config.yml file with the path to store camera_id
       # test results. This is a separate dict other than TestBeds.
@@ -837,19 +965,6 @@ def main():
       logging.debug('Final config file contents: %s', config_file_contents)
       new_yml_file_name = get_updated_yml_file(config_file_contents)
       logging.info('Using %s as temporary config yml file', new_yml_file_name)
-      if camera_id.rfind(its_session_utils.SUB_CAMERA_SEPARATOR) == -1:
-        scene_dir = os.listdir(
-            os.path.join(os.environ['CAMERA_ITS_TOP'], 'tests', testing_scene))
-        for file_name in scene_dir:
-          if file_name.endswith('.py') and 'test' in file_name:
-            scene_test_list.append(file_name)
-      else:  # sub-camera
-        if SUB_CAMERA_TESTS.get(testing_scene):
-          scene_test_list = [f'{test}.py' for test in SUB_CAMERA_TESTS[
-              testing_scene]]
-        else:
-          scene_test_list = []
-      scene_test_list.sort()
 
       # Run tests for scene
       logging.info('Running tests for %s with camera %s',
@@ -863,84 +978,78 @@ def main():
         if 'tests/' in test:
           cmd = [
               'python3',
-              os.path.join(os.environ['CAMERA_ITS_TOP'], test), '-c',
+              os.path.join(camera_its_top, test), '-c',
               f'{new_yml_file_name}'
           ]
         else:
           cmd = [
               'python3',
-              os.path.join(os.environ['CAMERA_ITS_TOP'], 'tests',
-                           testing_scene, test),
+              os.path.join(scene_tests_dir, test),
               '-c',
               f'{new_yml_file_name}'
           ]
         return_string = ''
-        for num_try in range(NUM_TRIES):
-          # Saves to mobly test summary file
-          # print only messages for manual lighting control testing
-          output = subprocess.Popen(
-              cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-          )
-          with output.stdout, open(
-              os.path.join(topdir, MOBLY_TEST_SUMMARY_TXT_FILE), 'wb'
-          ) as file:
-            for line in iter(output.stdout.readline, b''):
-              out = line.decode('utf-8').strip()
-              if '<ENTER>' in out: print(out)
-              file.write(line)
-          output.wait()
-
-          # Parse mobly logs to determine PASS/FAIL(*)/SKIP & socket FAILs
-          with open(
-              os.path.join(topdir, MOBLY_TEST_SUMMARY_TXT_FILE), 'r') as file:
-            test_code = output.returncode
+        # Echo <ENTER> prompts when the test or an operator may need them
+        needs_live_output = (test in _LIGHTING_CONTROL_TESTS or
+                             operator_may_be_prompted)
+        # Retry files created for this test, removed once it is recorded
+        created_files = []
+        try:
+          for num_try in range(NUM_TRIES):
+            # Each try writes its own file rather than rewriting a shared one
+            try_summary_path = (
+                mobly_summary_path if num_try == 0
+                else f'{mobly_summary_path}.retry{num_try}')
+            if num_try:
+              created_files.append(try_summary_path)
+            if needs_live_output:
+              # Saves to mobly test summary file
+              # print only messages for manual lighting control testing
+              output = subprocess.Popen(
+                  cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                  bufsize=TEST_OUTPUT_BUFSIZE
+              )
+              lines = []
+              with output.stdout, open(try_summary_path, 'wb') as file:
+                for line in iter(output.stdout.readline, b''):
+                  one_line = line.decode('utf-8')
+                  out = one_line.strip()
+                  if '<ENTER>' in out: print(out)
+                  file.write(line)
+                  lines.append(one_line.rstrip('\r\n'))
+              output.wait()
+              test_code = output.returncode
+            else:
+              # Nothing to echo, so let the child write the file directly
+              with open(try_summary_path, 'wb') as file:
+                test_code = subprocess.run(
+                    cmd, stdout=file, stderr=subprocess.STDOUT, check=False
+                ).returncode
+              with open(try_summary_path, 'r', encoding='utf-8') as file:
+                lines = file.read().splitlines()
+
+            # Parse mobly logs to determine PASS/FAIL(*)/SKIP & socket FAILs
             test_skipped = False
             test_not_yet_mandated = False
-            test_mpc_req = ''
-            perf_test_metrics = ''
-            hdr_mpc_req = ''
-            content = file.read()
-
-            # Find media performance class logging
-            lines = content.splitlines()
-            for one_line in lines:
-              # regular expression pattern must match
-              # MPC12_CAMERA_LAUNCH_PATTERN or MPC12_JPEG_CAPTURE_PATTERN in
-              # ItsTestActivity.java.
-              mpc_string_match = re.search(
-                  '^(1080p_jpeg_capture_time_ms:|camera_launch_time_ms:)',
-                  one_line)
-              if mpc_string_match:
-                test_mpc_req = one_line
-                break
-
-            for one_line in lines:
-              # regular expression pattern must match in ItsTestActivity.java.
-              gainmap_string_match = re.search('^has_gainmap:', one_line)
-              if gainmap_string_match:
-                hdr_mpc_req = one_line
-                break
+            socket_problem = False
 
+            # Find test status messages
             for one_line in lines:
-              # regular expression pattern must match in ItsTestActivity.java.
-              perf_metrics_string_match = re.search(
-                  '^test.*:',
-                  one_line)
-              if perf_metrics_string_match:
-                perf_test_metrics = one_line
-                # each test can add multiple metrics
-                results[s][PERFORMANCE_KEY].append(perf_test_metrics)
-
-            if 'Test skipped' in content:
+              if 'Test skipped' in one_line:
+                test_skipped = True
+              if its_session_utils.NOT_YET_MANDATED_MESSAGE in one_line:
+                test_not_yet_mandated = True
+              if 'Problem with socket' in one_line:
+                socket_problem = True
+
+            if test_skipped:
               return_string = 'SKIP '
               num_skip += 1
-              test_skipped = True
               break
 
-            if its_session_utils.NOT_YET_MANDATED_MESSAGE in content:
+            if test_not_yet_mandated:
               return_string = 'FAIL*'
               num_not_mandated_fail += 1
-              test_not_yet_mandated = True
               break
 
             if test_code == 0 and not test_skipped:
@@ -950,24 +1059,47 @@ def main():
 
             if test_code == 1 and not test_not_yet_mandated:
               return_string = 'FAIL '
-              if 'Problem with socket' in content and num_try != NUM_TRIES-1:
+              if socket_problem and num_try != NUM_TRIES-1:
                 logging.info('Retry %s/%s', s, test)
               else:
                 num_fail += 1
                 break
-            os.remove(os.path.join(topdir, MOBLY_TEST_SUMMARY_TXT_FILE))
-        status_prefix = ''
-        if testbed_index is not None:
-          status_prefix = config_file_test_key + ':'
-        logging.info('%s%s %s/%s', status_prefix, return_string, s, test)
-        test_name = test.split('/')[-1].split('.')[0]
-        results[s]['TEST_STATUS'].append({
-            'test': test_name,
-            'status': return_string.strip()})
-        if test_mpc_req:
-          results[s][METRICS_KEY].append(test_mpc_req)
-        if hdr_mpc_req:
-          results[s][METRICS_KEY].append(hdr_mpc_req)
+
+          # Find media performance class logging and performance metrics in
+          # the final try, keeping the first MPC and gainmap lines
+          test_mpc_req = ''
+          perf_test_metrics = []
+          hdr_mpc_req = ''
+          for one_line in lines:
+            if not test_mpc_req and one_line.startswith(_MPC_LINE_PREFIXES):
+              test_mpc_req = one_line
+            if not hdr_mpc_req and one_line.startswith(_GAINMAP_LINE_PREFIX):
+              hdr_mpc_req = one_line
+            # Only lines starting with 'test' can match the metrics pattern
+            if (one_line.startswith(_PERF_METRICS_LINE_PREFIX) and
+                _PERF_METRICS_LINE_PATTERN.match(one_line)):
+              # each test can add multiple metrics
+              perf_test_metrics.append(one_line)
+          status_prefix = ''
+          if testbed_index is not None:
+            status_prefix = config_file_test_key + ':'
+          logging.info('%s%s %s/%s', status_prefix, return_string, s, test)
+          test_name = os.path.splitext(os.path.basename(test))[0]
+          results[s]['TEST_STATUS'].append({
+              'test': test_name,
+              'status': return_string.strip()})
+          results[s][PERFORMANCE_KEY].extend(perf_test_metrics)
+          if test_mpc_req:
+            results[s][METRICS_KEY].append(test_mpc_req)
+          if hdr_mpc_req:
+            results[s][METRICS_KEY].append(hdr_mpc_req)
+        finally:
+          # Keep only the final try output, under the usual summary name
+          for path in created_files[:-1]:
+            if os.path.exists(path):
+              os.remove(path)
+          if created_files and os.path.exists(created_files[-1]):
+            os.replace(created_files[-1], mobly_summary_path)
         msg_short = f'{return_string} {test}'
         scene_test_summary += msg_short + '\n'
         if (test in _LIGHTING_CONTROL_TESTS and
@@ -975,7 +1107,7 @@ def main():
           print('Turn lights ON in rig and press <ENTER> to continue.')
 
       # unit is millisecond for execution time record in CtsVerifier
-      scene_end_time = int(round(time.time() * 1000))
+      scene_end_time = time.time_ns() // 1_000_000
       skip_string = ''
       tot_tests = len(scene_test_list)
       tot_tests_run = tot_tests - num_skip
@@ -1045,26 +1177,32 @@ def main():
       start = time.time()
       completed_testbeds = set()
       while time.time() < start + MERGE_RESULTS_TIMEOUT:
-        for i in range(num_testbeds):
-          if os.path.isfile(f'testbed_{i}_completed.tmp'):
+        for file_name in glob.glob('testbed_*_completed.tmp'):
+          completed_match = _COMPLETED_TESTBED_FILE_PATTERN.match(file_name)
+          if completed_match and int(completed_match.group(1)) < num_testbeds:
             start = time.time()
-            completed_testbeds.add(i)
+            completed_testbeds.add(int(completed_match.group(1)))
         # Already reported _MAIN_TESTBED's results.
         if len(completed_testbeds) == num_testbeds - 1:
           logging.info('All testbeds completed, merging results.')
+          # Each testbed device only needs to be compared once
+          similar_device_ids = set()
           for parsed_id, parsed_camera, parsed_results in (
               parse_testbeds(completed_testbeds)):
             logging.debug('Parsed id: %s, parsed cam: %s, parsed results: %s',
                           parsed_id, parsed_camera, parsed_results)
-            if not are_devices_similar(device_id, parsed_id):
-              logging.error('Device %s and device %s are not the same '
-                            'model/type/build/revision.',
-                            device_id, parsed_id)
-              return
+            if parsed_id not in similar_device_ids:
+              if not are_devices_similar(device_id, parsed_id):
+                logging.error('Device %s and device %s are not the same '
+                              'model/type/build/revision.',
+                              device_id, parsed_id)
+                return
+              similar_device_ids.add(parsed_id)
             report_result(device_id, parsed_camera, parsed_results)
           for temp_file in glob.glob('testbed_*.tmp'):
             os.remove(temp_file)
           break
+        time.sleep(MERGE_RESULTS_POLL_INTERVAL)
       else:
         logging.error('No testbeds finished in the last %d seconds, '
                       'but still expected data. '
@@ -14,7 +14,7 @@
 """Image processing utility functions."""
 
 
-import copy
+import functools
 import io
 import logging
 import math
@@ -42,15 +42,17 @@ _NUM_RAW_CHANNELS = 4  # R, Gr, Gb, B
 LENS_SHADING_MAP_ON = 1
 
 # The matrix is from JFIF spec
-DEFAULT_YUV_TO_RGB_CCM = numpy.matrix([[1.000, 0.000, 1.402],
-                                       [1.000, -0.344, -0.714],
-                                       [1.000, 1.772, 0.000]])
+DEFAULT_YUV_TO_RGB_CCM = numpy.array([[1.000, 0.000, 1.402],
+                                      [1.000, -0.344, -0.714],
+                                      [1.000, 1.772, 0.000]],
+                                     dtype=numpy.float32)
 
 DEFAULT_YUV_OFFSETS = numpy.array([0, 128, 128], dtype=numpy.uint8)
 MAX_LUT_SIZE = 65536
-DEFAULT_GAMMA_LUT = numpy.array([
-    math.floor((MAX_LUT_SIZE-1) * math.pow(i/(MAX_LUT_SIZE-1), 1/2.2) + 0.5)
-    for i in range(MAX_LUT_SIZE)])
+DEFAULT_GAMMA_LUT = numpy.floor(
+    (MAX_LUT_SIZE-1) *
+    numpy.power(numpy.arange(MAX_LUT_SIZE) / (MAX_LUT_SIZE-1), 1/2.2) +
+    0.5).astype(numpy.uint16)
 RGB2GRAY_WEIGHTS = (0.299, 0.587, 0.114)
 TEST_IMG_DIR = os.path.join(os.environ['CAMERA_ITS_TOP'], 'test_images')
 
@@ -156,13 +158,19 @@ def apply_lens_shading_map(color_plane, black_level, white_level, lsc_map):
   Returns:
     color_plane with lsc applied.
   """
-  logging.debug('color plane pre-lsc min, max: %.4f, %.4f',
-                numpy.min(color_plane), numpy.max(color_plane))
-  color_plane = (numpy.multiply((color_plane * white_level - black_level),
-                                lsc_map)
-                 + black_level) / white_level
-  logging.debug('color plane post-lsc min, max: %.4f, %.4f',
-                numpy.min(color_plane), numpy.max(color_plane))
+  debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+  if debug:
+    logging.debug('color plane pre-lsc min, max: %.4f, %.4f',
+                  numpy.min(color_plane), numpy.max(color_plane))
+  # ((p * white - black) * lsc + black) / white, normalized by white_level so
+  # that one temporary is allocated and then updated in place.
+  black_level_norm = black_level / white_level
+  color_plane = numpy.subtract(color_plane, black_level_norm)
+  color_plane *= lsc_map
+  color_plane += black_level_norm
+  if debug:
+    logging.debug('color plane post-lsc min, max: %.4f, %.4f',
+                  numpy.min(color_plane), numpy.max(color_plane))
   return color_plane
 
 
@@ -176,33 +184,41 @@ def populate_lens_shading_map(img_shape, lsc_map):
   Returns:
     value for lens shading map at point (x, y) in the image.
   """
-  img_w, img_h = img_shape[1], img_shape[0]
-  map_w, map_h = lsc_map.shape[1], lsc_map.shape[0]
+  u_min, u_max, u_frac = _lsc_map_interp_weights(
+      img_shape[1], lsc_map.shape[1])
+  v_min, v_max, v_frac = _lsc_map_interp_weights(
+      img_shape[0], lsc_map.shape[0])
 
-  x, y = numpy.meshgrid(numpy.arange(img_w), numpy.arange(img_h))
+  # Bilinear interpolation is separable: interpolate each map row along x
+  # to full width, then interpolate those rows along y to full height.
+  lsc_rows = lsc_map[:, u_min] * (1 - u_frac) + lsc_map[:, u_max] * u_frac
+  v_frac = v_frac[:, numpy.newaxis]
+  return lsc_rows[v_min] * (1 - v_frac) + lsc_rows[v_max] * v_frac
 
-  # (u,v) is lsc map location, values [0, map_w-1], [0, map_h-1]
-  # Vectorized calculations
-  u = x * (map_w - 1) / (img_w - 1)
-  v = y * (map_h - 1) / (img_h - 1)
-  u_min = numpy.floor(u).astype(int)
-  v_min = numpy.floor(v).astype(int)
-  u_frac = u - u_min
-  v_frac = v - v_min
-  u_max = numpy.where(u_frac > 0, u_min + 1, u_min)
-  v_max = numpy.where(v_frac > 0, v_min + 1, v_min)
 
-  # Gather LSC values, handling edge cases (optional)
-  lsc_tl = lsc_map[(v_min, u_min)]
-  lsc_tr = lsc_map[(v_min, u_max)]
-  lsc_bl = lsc_map[(v_max, u_min)]
-  lsc_br = lsc_map[(v_max, u_max)]
+@functools.lru_cache(maxsize=8)
+def _lsc_map_interp_weights(img_len, map_len):
+  """Get 1D LSC map indices and weights for one axis of a RAW image.
 
-  # Bilinear interpolation (vectorized)
-  lsc_t = lsc_tl * (1 - u_frac) + lsc_tr * u_frac
-  lsc_b = lsc_bl * (1 - u_frac) + lsc_br * u_frac
+  They depend only on the image and map sizes, so they are shared by every
+  color plane and every capture of the same size.
 
-  return lsc_t * (1 - v_frac) + lsc_b * v_frac
+  Args:
+    img_len: int; RAW image width or height.
+    map_len: int; lens shading map width or height.
+
+  Returns:
+    Read-only (idx_min, idx_max, frac) arrays of length img_len; frac is
+    float32 so that a float32 map is interpolated in float32.
+  """
+  # Map location of each pixel, values [0, map_len-1]
+  pos = numpy.arange(img_len) * (map_len - 1) / (img_len - 1)
+  idx_min = numpy.floor(pos).astype(int)
+  frac = (pos - idx_min).astype(numpy.float32)
+  idx_max = numpy.where(frac > 0, idx_min + 1, idx_min)
+  for a in (idx_min, idx_max, frac):
+    a.flags.writeable = False
+  return idx_min, idx_max, frac
 
 
 def unpack_lsc_map_from_metadata(metadata):
@@ -220,7 +236,8 @@ def unpack_lsc_map_from_metadata(metadata):
   logging.debug(
       'lensShadingCorrectionMap (H, W): (%d, %d)', lsc_map_h, lsc_map_w
   )
-  return numpy.array(lsc_map).reshape(lsc_map_h, lsc_map_w, _NUM_RAW_CHANNELS)
+  return numpy.array(lsc_map, dtype=numpy.float32).reshape(
+      lsc_map_h, lsc_map_w, _NUM_RAW_CHANNELS)
 
 
 def convert_raw_capture_to_rgb_image(cap_raw, props, raw_fmt,
@@ -344,7 +361,7 @@ def unpack_raw10_capture(cap, is_quad_bayer=False):
   w, h = cap['width'], cap['height']
   if w % 4 != 0:
     raise error_util.CameraItsError('Invalid raw-10 buffer width')
-  cap = copy.deepcopy(cap)
+  cap = dict(cap)
   cap['data'] = unpack_raw10_image(cap['data'].reshape(h, w * 5 // 4))
   cap['format'] = 'rawQuadBayer' if is_quad_bayer else 'raw'
   return cap
@@ -371,16 +388,13 @@ def unpack_raw10_image(img):
   msbs = msbs.astype(numpy.uint16)
   msbs = numpy.left_shift(msbs, 2)
   msbs = msbs.reshape(h, w)
-  # Cut out the 4x2b LSBs and put each in bits [1:0] of their own 8b words.
-  lsbs = img[::, 4::5].reshape(h, w // 4)
-  lsbs = numpy.right_shift(
-      numpy.packbits(numpy.unpackbits(lsbs).reshape((h, w // 4, 4, 2)), 3), 6)
-  # Pair the LSB bits group to 0th pixel instead of 3rd pixel
-  lsbs = lsbs.reshape(h, w // 4, 4)[:, :, ::-1]
-  lsbs = lsbs.reshape(h, w)
-  # Fuse the MSBs and LSBs back together
-  img16 = numpy.bitwise_or(msbs, lsbs).reshape(h, w)
-  return img16
+  # Cut out the bytes holding the 4x2b LSBs.
+  lsb_bytes = img[::, 4::5].astype(numpy.uint16)
+  # Fuse the LSBs into the MSBs in place, bits [1:0] going to the 0th pixel
+  pixels = msbs.reshape(h, w // 4, 4)
+  for i in range(4):
+    pixels[:, :, i] |= (lsb_bytes >> (2 * i)) & 0x3
+  return msbs
 
 
 def unpack_raw12_capture(cap):
@@ -397,7 +411,7 @@ def unpack_raw12_capture(cap):
   w, h = cap['width'], cap['height']
   if w % 2 != 0:
     raise error_util.CameraItsError('Invalid raw-12 buffer width')
-  cap = copy.deepcopy(cap)
+  cap = dict(cap)
   cap['data'] = unpack_raw12_image(cap['data'].reshape(h, w * 3 // 2))
   cap['format'] = 'raw'
   return cap
@@ -424,16 +438,13 @@ def unpack_raw12_image(img):
   msbs = msbs.astype(numpy.uint16)
   msbs = numpy.left_shift(msbs, 4)
   msbs = msbs.reshape(h, w)
-  # Cut out the 2x4b LSBs and put each in bits [3:0] of their own 8b words.
-  lsbs = img[::, 2::3].reshape(h, w // 2)
-  lsbs = numpy.right_shift(
-      numpy.packbits(numpy.unpackbits(lsbs).reshape((h, w // 2, 2, 4)), 3), 4)
-  # Pair the LSB bits group to pixel 0 instead of pixel 1
-  lsbs = lsbs.reshape(h, w // 2, 2)[:, :, ::-1]
-  lsbs = lsbs.reshape(h, w)
-  # Fuse the MSBs and LSBs back together
-  img16 = numpy.bitwise_or(msbs, lsbs).reshape(h, w)
-  return img16
+  # Cut out the bytes holding the 2x4b LSBs.
+  lsb_bytes = img[::, 2::3].astype(numpy.uint16)
+  # Fuse the LSBs into the MSBs in place, bits [3:0] going to pixel 0
+  pixels = msbs.reshape(h, w // 2, 2)
+  pixels[:, :, 0] |= lsb_bytes & 0xF
+  pixels[:, :, 1] |= lsb_bytes >> 4
+  return msbs
 
 
 def convert_yuv420_planar_to_rgb_image(y_plane, u_plane, v_plane,
@@ -457,15 +468,19 @@ def convert_yuv420_planar_to_rgb_image(y_plane, u_plane, v_plane,
   y = numpy.subtract(y_plane, yuv_off[0])
   u = numpy.subtract(u_plane, yuv_off[1]).view(numpy.int8)
   v = numpy.subtract(v_plane, yuv_off[2]).view(numpy.int8)
-  u = u.reshape(h // 2, w // 2).repeat(2, axis=1).repeat(2, axis=0)
-  v = v.reshape(h // 2, w // 2).repeat(2, axis=1).repeat(2, axis=0)
-  yuv = numpy.dstack([y, u.reshape(w * h), v.reshape(w * h)])
-  flt = numpy.empty([h, w, 3], dtype=numpy.float32)
-  flt.reshape(w * h * 3)[:] = yuv.reshape(h * w * 3)[:]
-  flt = numpy.dot(flt.reshape(w * h, 3), ccm_yuv_to_rgb.T).clip(0, 255)
-  rgb = numpy.empty([h, w, 3], dtype=numpy.uint8)
-  rgb.reshape(w * h * 3)[:] = flt.reshape(w * h * 3)[:]
-  return rgb.astype(numpy.float32) / 255.0
+  # Write Y, U, V straight into one float buffer, broadcasting each U and V
+  # sample over its 2x2 block instead of expanding the chroma planes.
+  yuv = numpy.empty([h // 2, 2, w // 2, 2, 3], dtype=numpy.float32)
+  yuv[..., 0] = y.reshape(h // 2, 2, w // 2, 2)
+  yuv[..., 1] = u.reshape(h // 2, 1, w // 2, 1)
+  yuv[..., 2] = v.reshape(h // 2, 1, w // 2, 1)
+  ccm = numpy.asarray(ccm_yuv_to_rgb, dtype=numpy.float32)
+  flt = numpy.dot(yuv.reshape(w * h, 3), ccm.T)
+  numpy.clip(flt, 0, 255, out=flt)
+  # Truncate in place as the uint8 store would, then normalize to [0, 1].
+  numpy.floor(flt, out=flt)
+  flt /= 255.0
+  return flt.reshape(h, w, 3)
 
 
 def decompress_jpeg_to_rgb_image(jpeg_buffer):
@@ -480,7 +495,7 @@ def decompress_jpeg_to_rgb_image(jpeg_buffer):
   img = Image.open(io.BytesIO(jpeg_buffer))
   w = img.size[0]
   h = img.size[1]
-  return numpy.array(img).reshape((h, w, 3)) / 255.0
+  return numpy.asarray(img).reshape((h, w, 3)) / 255.0
 
 
 def decompress_jpeg_to_yuv_image(jpeg_buffer):
@@ -496,7 +511,7 @@ def decompress_jpeg_to_yuv_image(jpeg_buffer):
   img = img.convert('YCbCr')
   w = img.size[0]
   h = img.size[1]
-  return numpy.array(img).reshape((h, w, 3)) / 255.0
+  return numpy.asarray(img).reshape((h, w, 3)) / 255.0
 
 
 def extract_luma_from_patch(cap, patch_x, patch_y, patch_w, patch_h):
@@ -542,14 +557,14 @@ def _convert_quad_bayer_img_to_bayer_channels(quad_bayer_img, props=None):
   quad_bayer_cfa_order = get_canonical_cfa_order(props, is_quad_bayer=True)
 
   # Bayer channels are in the order of R, Gr, Gb and B.
-  bayer_channels = []
+  # Average every four quad Bayer channels into a standard Bayer channel,
+  # all at once as a product with a matrix of averaging weights.
+  weights = numpy.zeros((4, num_channels), dtype='<f')
   for ch in range(4):
-    channel_img = numpy.zeros(shape=(height, width), dtype='<f')
-    # Average every four quad Bayer channels into a standard Bayer channel.
-    for i in quad_bayer_cfa_order[4 * ch: 4 * (ch + 1)]:
-      channel_img[:, :] += quad_bayer_img[:, :, i]
-    bayer_channels.append(channel_img / 4)
-  return bayer_channels
+    weights[ch, quad_bayer_cfa_order[4 * ch: 4 * (ch + 1)]] = 0.25
+  bayer_channels = numpy.dot(
+      weights, quad_bayer_img.reshape(height * width, num_channels).T)
+  return list(bayer_channels.astype('<f').reshape(4, height, width))
 
 
 def subsample(image, num_channels=4):
@@ -568,21 +583,18 @@ def subsample(image, num_channels=4):
         f'{noise_model_constants.VALID_NUM_CHANNELS}.'
     )
 
-  size_h, size_v = image.shape[1], image.shape[0]
-
   # Subsample step size, which is the horizontal or vertical pixel interval
   # between two adjacent pixels of the same channel.
   stride = int(numpy.sqrt(num_channels))
-  subsample_img = lambda img, i, h, v, s: img[i // s: v: s, i % s: h: s]
-  channel_img = numpy.empty((
-      image.shape[0] // stride,
-      image.shape[1] // stride,
-      num_channels,
-  ))
+  size_h, size_v = image.shape[1] // stride, image.shape[0] // stride
+  channel_img = numpy.empty((size_v, size_h, num_channels))
 
-  for i in range(num_channels):
-    sub_img = subsample_img(image, i, size_h, size_v, stride)
-    channel_img[:, :, i] = sub_img
+  # Channel i is the pixel at row i // stride, column i % stride of each
+  # stride x stride block, so copy all channels in one strided assignment.
+  blocks = image[:size_v * stride, :size_h * stride].reshape(
+      size_v, stride, size_h, stride)
+  channel_img.reshape(size_v, size_h, stride, stride)[:] = blocks.transpose(
+      0, 2, 1, 3)
 
   return channel_img
 
@@ -643,9 +655,9 @@ def convert_capture_to_planes(cap, props=None):
     assert_props_is_not_none(props)
     is_quad_bayer = 'QuadBayer' in cap['format']
     white_level = get_white_level(props, cap['metadata'])
-    img = numpy.ndarray(
-        shape=(h * w,), dtype='<u2', buffer=cap['data'][0:w * h * 2])
-    img = img.astype(numpy.float32).reshape(h, w) / white_level
+    img = numpy.frombuffer(cap['data'], dtype='<u2', count=w * h)
+    img = img.reshape(h, w).astype(numpy.float32)
+    img /= white_level
     if is_quad_bayer:
       pixel_array_size = props.get(
           'android.sensor.info.pixelArraySizeMaximumResolution'
@@ -699,12 +711,13 @@ def convert_capture_to_planes(cap, props=None):
       )
       return bayer_channels
     else:
-      # Separate the image planes.
+      # Separate the image planes as strided views of each 2x2 block.
+      img = img.reshape(h // 2, 2, w // 2, 2)
       imgs = [
-          img[::2].reshape(w * h // 2)[::2].reshape(h // 2, w // 2, 1),
-          img[::2].reshape(w * h // 2)[1::2].reshape(h // 2, w // 2, 1),
-          img[1::2].reshape(w * h // 2)[::2].reshape(h // 2, w // 2, 1),
-          img[1::2].reshape(w * h // 2)[1::2].reshape(h // 2, w // 2, 1),
+          img[:, 0, :, 0, numpy.newaxis],
+          img[:, 0, :, 1, numpy.newaxis],
+          img[:, 1, :, 0, numpy.newaxis],
+          img[:, 1, :, 1, numpy.newaxis],
       ]
       return [imgs[i] for i in idxs]
   elif cap['format'] in (
@@ -762,14 +775,9 @@ def downscale_image(img, f):
   h = (h//f)*f
   w = (w//f)*f
   img = img[0:h:, 0:w:, ::]
-  chs = []
-  for i in range(chans):
-    ch = img.reshape(h*w*chans)[i::chans].reshape(h, w)
-    ch = ch.reshape(h, w//f, f).mean(2).reshape(h, w//f)
-    ch = ch.T.reshape(w//f, h//f, f).mean(2).T.reshape(h//f, w//f)
-    chs.append(ch.reshape(h*w//(f*f)))
-  img = numpy.vstack(chs).T.reshape(h//f, w//f, chans)
-  return img
+  # Average each f x f block of all channels at once: rows of a block first,
+  # which adds whole contiguous rows, then its columns
+  return img.reshape(h//f, f, w//f, f, chans).mean(axis=1).mean(axis=2)
 
 
 def convert_raw_to_rgb_image(r_plane, gr_plane, gb_plane, b_plane, props,
@@ -812,19 +820,27 @@ def convert_raw_to_rgb_image(r_plane, gr_plane, gb_plane, b_plane, props,
   # the black level from each pixel.
   scale = white_level / (white_level - max(black_levels))
 
-  # Three-channel black levels, normalized to [0,1] by white_level.
+  # Three-channel black levels, normalized to [0,1] by white_level. G holds
+  # gr + gb, so its black level is doubled and its gain halved.
   black_levels = numpy.array(
       [b / white_level for b in [black_levels[i] for i in [0, 1, 3]]])
+  black_levels[1] *= 2.0
 
-  # Three-channel gains.
-  gains = numpy.array([gains[i] for i in [0, 1, 3]])
+  # Three-channel gains, premultiplied by the scale.
+  gains = numpy.array([gains[i] for i in [0, 1, 3]]) * scale
+  gains[1] *= 0.5
 
   h, w = r_plane.shape[:2]
-  img = numpy.dstack([r_plane, (gr_plane + gb_plane) / 2.0, b_plane])
-  img = (((img.reshape(h, w, 3) - black_levels) * scale) * gains).clip(0.0, 1.0)
+  img = numpy.empty((h, w, 3))
+  img[:, :, 0] = r_plane.reshape(h, w)
+  numpy.add(gr_plane.reshape(h, w), gb_plane.reshape(h, w), out=img[:, :, 1])
+  img[:, :, 2] = b_plane.reshape(h, w)
+  img -= black_levels
+  img *= gains
+  numpy.clip(img, 0.0, 1.0, out=img)
   if apply_ccm_raw_to_rgb:
-    img = numpy.dot(
-        img.reshape(w * h, 3), ccm.T).reshape((h, w, 3)).clip(0.0, 1.0)
+    img = numpy.dot(img.reshape(w * h, 3), ccm.T).reshape((h, w, 3))
+    numpy.clip(img, 0.0, 1.0, out=img)
   return img
 
 
@@ -1082,7 +1098,41 @@ def unpack_rawstats_capture(cap, num_channels=4):
   return mean_image, var_image
 
 
-def get_image_patch(img, xnorm, ynorm, wnorm, hnorm):
+def unpack_rawstats_cell(cap, x, y, ch, num_channels=4):
+  """Unpacks the mean and variance of a single stats image cell and channel.
+
+  Reads the two values directly from the capture buffer, without building
+  the full mean and variance images as unpack_rawstats_capture does.
+
+  Args:
+    cap: A capture object as returned by its_session_utils.do_capture.
+    x: Column of the stats grid cell.
+    y: Row of the stats grid cell.
+    ch: Color channel index within the cell.
+    num_channels: The number of color channels in the stats image capture, which
+      can be one of noise_model_constants.VALID_NUM_CHANNELS.
+
+  Returns:
+    Tuple (mean, var) of non-normalized float values for the cell channel.
+  """
+  if cap['format'] not in noise_model_constants.VALID_RAW_STATS_FORMATS:
+    raise AssertionError(f"Unsupported stats format: {cap['format']}")
+
+  if num_channels not in noise_model_constants.VALID_NUM_CHANNELS:
+    raise AssertionError(
+        f'Unsupported number of channels {num_channels}, which should be in'
+        f' {noise_model_constants.VALID_NUM_CHANNELS}.'
+    )
+
+  w = cap['width']
+  h = cap['height']
+  img = numpy.frombuffer(
+      cap['data'], dtype='<f', count=2 * h * w * num_channels)
+  idx = (y * w + x) * num_channels + ch
+  return img[idx], img[h * w * num_channels + idx]
+
+
+def get_image_patch(img, xnorm, ynorm, wnorm, hnorm, dtype=None):
   """Get a patch (tile) of an image.
 
   Args:
@@ -1091,6 +1141,7 @@ def get_image_patch(img, xnorm, ynorm, wnorm, hnorm):
    ynorm:
    wnorm:
    hnorm: Normalized (in [0,1]) coords for the tile.
+   dtype: optional numpy dtype for the patch. Defaults to the dtype of img.
 
   Returns:
      Numpy float image array of the patch.
@@ -1102,9 +1153,12 @@ def get_image_patch(img, xnorm, ynorm, wnorm, hnorm):
   wtile = int(math.floor(wnorm * wfull))
   htile = int(math.floor(hnorm * hfull))
   if len(img.shape) == 2:
-    return img[ytile:ytile + htile, xtile:xtile + wtile].copy()
+    patch = img[ytile:ytile + htile, xtile:xtile + wtile]
   else:
-    return img[ytile:ytile + htile, xtile:xtile + wtile, :].copy()
+    patch = img[ytile:ytile + htile, xtile:xtile + wtile, :]
+  if dtype is None:
+    return patch.copy()
+  return patch.astype(dtype)
 
 
 def compute_image_means(img):
@@ -1139,6 +1193,26 @@ def compute_image_variances(img):
   return variances
 
 
+def compute_image_means_and_variances(img):
+  """Calculate the mean and variance of each color channel in the image.
+
+  The channel means are computed once and reused for the variances, so the
+  image is traversed fewer times than calling compute_image_means and
+  compute_image_variances separately.
+
+  Args:
+    img: Numpy float image array, with pixel values in [0,1].
+
+  Returns:
+    Tuple of numpy arrays of mean values and variance values, one per color
+    channel in the image.
+  """
+  means = numpy.mean(img, axis=(0, 1), dtype=numpy.float64)
+  variances = numpy.mean(numpy.square(img - means), axis=(0, 1),
+                         dtype=numpy.float64)
+  return means, variances
+
+
 def compute_image_sharpness(img):
   """Calculate the sharpness of input image.
 
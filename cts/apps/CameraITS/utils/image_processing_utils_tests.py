@@ -70,6 +70,64 @@ class ImageProcessingUtilsTest(unittest.TestCase):
         image_processing_utils.unpack_raw10_image(img_raw10),
         img_check))
 
+  def test_unpack_rawstats_cell(self):
+    """Unit test for unpack_rawstats_cell.
+
+    Values should match the same cell of unpack_rawstats_capture.
+    """
+    img_w, img_h, num_channels = 3, 2, 4
+    stats = numpy.arange(
+        2 * img_h * img_w * num_channels, dtype='<f')
+    cap = {'format': 'rawStats', 'width': img_w, 'height': img_h,
+           'data': stats.tobytes()}
+    mean_img, var_img = image_processing_utils.unpack_rawstats_capture(cap)
+    for x, y, ch in [(0, 0, 0), (2, 1, 3), (1, 1, 2)]:
+      mean, var = image_processing_utils.unpack_rawstats_cell(cap, x, y, ch)
+      self.assertEqual(mean, mean_img[y, x, ch])
+      self.assertEqual(var, var_img[y, x, ch])
+
+  def test_populate_lens_shading_map(self):
+    """Unit test for populate_lens_shading_map.
+
+    Map corners land on image corners and values in between are bilinear.
+    """
+    lsc_map = numpy.array([[1.0, 2.0], [3.0, 5.0]])
+    lsc_map_fs = image_processing_utils.populate_lens_shading_map(
+        (5, 9), lsc_map)
+    self.assertEqual(lsc_map_fs.shape, (5, 9))
+    numpy.testing.assert_allclose(
+        lsc_map_fs[::4, ::8], lsc_map, rtol=1e-6)
+    numpy.testing.assert_allclose(lsc_map_fs[2, 4], 2.75, rtol=1e-6)
+    numpy.testing.assert_allclose(lsc_map_fs[0, 2], 1.25, rtol=1e-6)
+
+  def test_populate_lens_shading_map_off_grid(self):
+    """Unit test for populate_lens_shading_map at fractional positions.
+
+    Sample positions such as 0.3 and 1/3 are not multiples of 1/32, so
+    interpolation that snaps to a fixed sub-pixel grid would not match.
+    """
+    lsc_map = numpy.array([[1.0, 1.7, 2.9, 3.1],
+                           [1.3, 2.2, 4.0, 2.6],
+                           [2.1, 1.9, 3.3, 5.2]])
+    img_h, img_w = 7, 11
+    map_h, map_w = lsc_map.shape
+    expected = numpy.empty((img_h, img_w))
+    for y in range(img_h):
+      for x in range(img_w):
+        u = x * (map_w - 1) / (img_w - 1)
+        v = y * (map_h - 1) / (img_h - 1)
+        u0 = min(int(u), map_w - 2)
+        v0 = min(int(v), map_h - 2)
+        du, dv = u - u0, v - v0
+        expected[y, x] = (
+            lsc_map[v0, u0] * (1 - du) * (1 - dv) +
+            lsc_map[v0, u0 + 1] * du * (1 - dv) +
+            lsc_map[v0 + 1, u0] * (1 - du) * dv +
+            lsc_map[v0 + 1, u0 + 1] * du * dv)
+    lsc_map_fs = image_processing_utils.populate_lens_shading_map(
+        (img_h, img_w), lsc_map)
+    numpy.testing.assert_allclose(lsc_map_fs, expected, rtol=1e-5)
+
   def test_compute_image_sharpness(self):
     """Unit test for compute_img_sharpness.
 
@@ -110,6 +168,27 @@ class ImageProcessingUtilsTest(unittest.TestCase):
     y_ref = [i*2 for i in ref_image]
     self.assertTrue(numpy.allclose(y, y_ref, atol=1/lut_max))
 
+  def test_compute_image_means_and_variances(self):
+    """Unit test for compute_image_means_and_variances.
+
+    Results should match compute_image_means and compute_image_variances.
+    """
+    img = numpy.random.default_rng(0).random((48, 64, 3))
+    means, variances = image_processing_utils.compute_image_means_and_variances(
+        img)
+    self.assertTrue(numpy.allclose(
+        means, image_processing_utils.compute_image_means(img)))
+    self.assertTrue(numpy.allclose(
+        variances, image_processing_utils.compute_image_variances(img)))
+
+  def test_get_image_patch_dtype(self):
+    """Unit test for get_image_patch with a dtype override."""
+    img = numpy.random.default_rng(0).random((48, 64, 3))
+    patch = image_processing_utils.get_image_patch(
+        img, 0.25, 0.25, 0.5, 0.5, dtype=numpy.float32)
+    self.assertEqual(patch.dtype, numpy.float32)
+    self.assertTrue(numpy.allclose(patch, img[12:36, 16:48, :]))
+
   def test_p3_img_has_wide_gamut(self):
     # (255, 0, 0) and (0, 255, 0) in sRGB converted to Display P3
     srgb_red = numpy.array([[[234, 51, 35]]], dtype='uint8')
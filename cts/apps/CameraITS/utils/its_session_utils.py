@@ -411,6 +411,9 @@ class ItsSession(object):
     self._device_id = device_id
     self._hidden_physical_id = hidden_physical_id
     self._override_to_portrait = override_to_portrait
+    # Cache query responses that are fixed for the lifetime of the session.
+    self._hlg10_size_fps_support = {}
+    self._stream_combination_support = {}
 
     # Initialize device id and adb command.
     self.adb = 'adb -s ' + self._device_id
@@ -783,6 +786,10 @@ class ItsSession(object):
       Boolean: True if device supports HLG10 video recording, False in
       all other cases.
     """
+    cache_key = (video_size, max_fps)
+    if cache_key in self._hlg10_size_fps_support:
+      return self._hlg10_size_fps_support[cache_key]
+
     cmd = {}
     cmd[_CMD_NAME_STR] = 'isHLG10SupportedForSizeAndFps'
     cmd[_CAMERA_ID_STR] = self._camera_id
@@ -793,7 +800,9 @@ class ItsSession(object):
     data, _ = self.__read_response_from_socket()
     if data[_TAG_STR] != 'hlg10Response':
       raise error_util.CameraItsError('Failed to query HLG10 support')
-    return data[_STR_VALUE_STR] == 'true'
+    supported = data[_STR_VALUE_STR] == 'true'
+    self._hlg10_size_fps_support[cache_key] = supported
+    return supported
 
   def is_p3_capture_supported(self):
     """Query whether the camera device supports P3 image capture.
@@ -2394,13 +2403,20 @@ class ItsSession(object):
     if settings:
       cmd['settings'] = settings
 
-    self.sock.send(json.dumps(cmd).encode() + '\n'.encode())
+    # The serialized command doubles as the cache key for repeated queries.
+    cmd_str = json.dumps(cmd, sort_keys=True)
+    if cmd_str in self._stream_combination_support:
+      return self._stream_combination_support[cmd_str]
+
+    self.sock.send(cmd_str.encode() + '\n'.encode())
 
     data, _ = self.__read_response_from_socket()
     if data[_TAG_STR] != 'streamCombinationSupport':
       raise error_util.CameraItsError('Failed to query stream combination')
 
-    return data[_STR_VALUE_STR] == 'supportedCombination'
+    supported = data[_STR_VALUE_STR] == 'supportedCombination'
+    self._stream_combination_support[cmd_str] = supported
+    return supported
 
   def is_camera_privacy_mode_supported(self):
     """Query whether the mobile device supports camera privacy mode.
@@ -2926,7 +2942,7 @@ def pull_file_from_dut(dut, dut_path, log_folder):
     filename of file pulled from dut
   """
   dut.adb.pull([dut_path, log_folder])
-  file_name = (dut_path.split('/')[-1])
+  file_name = os.path.basename(dut_path)
   logging.debug('%s pulled from dut', file_name)
   return file_name
 
@@ -199,7 +199,7 @@ def verify_preview_stabilization(recording_obj, gyro_events,
     and a failure message if the recorded video isn't properly stablilized.
   """
 
-  file_name = recording_obj['recordedOutputPath'].split('/')[-1]
+  file_name = os.path.basename(recording_obj['recordedOutputPath'])
   logging.debug('recorded file name: %s', file_name)
   video_size = recording_obj['videoSize']
   logging.debug('video size: %s', video_size)